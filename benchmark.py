@@ -0,0 +1,666 @@
+#!/usr/bin/env python3
+'''Offline end-to-end benchmark of codesign.py
+
+Puts stand-in gsutil, codesign, xcrun, zip and unzip executables on PATH,
+generates synthetic engine archives shaped like codesign.ARCHIVES (nested
+framework zips included) in a local directory standing in for the bucket,
+then runs codesign.py end to end and reports wall time, peak RSS and bytes
+written. Runs on plain Linux, no credentials needed.
+
+Usage:
+    ./benchmark.py [options] [-- <extra codesign.py arguments>]
+
+The stand-in tools are this same file, invoked through small shims; their
+latencies and failure rates come from BENCH_* environment variables that
+the harness sets from its options.
+'''
+
+import argparse
+import base64
+import datetime
+import hashlib
+import json
+import os
+import plistlib
+import random
+import shutil
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import zipfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+BUCKET_PREFIX = 'flutter_infra_release'
+
+# Fixed member timestamps, so the same seed always yields identical archives
+SYNTHETIC_DATE_TIME = (2020, 1, 1, 0, 0, 0)
+
+FAKE_TOOLS = [
+    'codesign',
+    'gsutil',
+    'unzip',
+    'xcrun',
+    'zip',
+    ]
+
+# Submissions per page of the fake notarization history
+NOTARY_HISTORY_PAGE_SIZE = 50
+
+# Arguments passed to codesign.py so that notarization polling does not
+# dominate the measurement
+FAST_POLLING = [
+    '--notary-initial-delay', '0',
+    '--notary-poll-interval', '1',
+    '--notary-max-poll-interval', '2',
+    '--notary-checks-per-minute', '6000',
+    ]
+
+# Mach-O and code signature fixtures, written independently of the
+# inspector in codesign.py so that they check it
+MH_MAGIC_64 = 0xfeedfacf
+MH_EXECUTE = 2
+MH_DYLIB = 6
+CPU_TYPE_X86_64 = 0x1000007
+CPU_TYPE_ARM64 = 0x100000c
+FAT_MAGIC = 0xcafebabe
+FAT_MAGIC_64 = 0xcafebabf
+FAT_ALIGN = 14
+LC_CODE_SIGNATURE = 0x1d
+# Room after each Mach-O header for the LC_CODE_SIGNATURE codesign adds
+LOAD_COMMAND_SPACE = 16
+CS_ADHOC = 0x2
+CS_RUNTIME = 0x10000
+# Stand-in CMS SignedData carrying the OID of pkcs7-signedData, followed by
+# that of id-aa-timeStampToken when timestamped
+FAKE_CMS = b'\x30\x80\x06\x09\x2a\x86\x48\x86\xf7\x0d\x01\x07\x02'
+FAKE_TIMESTAMP = b'\x06\x0b\x2a\x86\x48\x86\xf7\x0d\x01\x09\x10\x02\x0e'
+
+
+def env_float(name, default=0.0):
+    '''Read a float from the environment'''
+    return float(os.environ.get(name, default))
+
+
+def simulate(tool):
+    '''Sleep for the tool's latency, returns True if this call should fail'''
+    prefix = 'BENCH_%s_' % tool.upper()
+    time.sleep(env_float(prefix + 'LATENCY'))
+    return random.random() < env_float(prefix + 'FAILURE_RATE')
+
+
+def bucket_path(path):
+    '''Map a gs:// URL onto the local bucket directory'''
+    if path.startswith('gs://'):
+        return os.path.join(os.environ['BENCH_BUCKET'], path[len('gs://'):])
+    return path
+
+
+def fake_gsutil(args):
+    '''gsutil [-m] [-o option]... cp <source> <destination> | stat <url>'''
+    while args and args[0].startswith('-'):
+        if args[0] == '-o':
+            args = args[1:]
+        args = args[1:]
+    if simulate('gsutil'):
+        sys.stderr.write('ServiceException: 503 simulated failure\n')
+        return 1
+    command, operands = args[0], args[1:]
+    if command == 'cp':
+        operands = [operand for operand in operands if operand == '-' or not operand.startswith('-')]
+        source, destination = bucket_path(operands[0]), bucket_path(operands[1])
+        if not os.path.isfile(source):
+            sys.stderr.write('CommandException: No URLs matched: %s\n' % operands[0])
+            return 1
+        if destination == '-':
+            with open(source, 'rb') as source_file:
+                shutil.copyfileobj(source_file, sys.stdout.buffer, 1024 * 1024)
+            return 0
+        dirname = os.path.dirname(destination)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        shutil.copyfile(source, destination)
+        return 0
+    if command == 'stat':
+        path = bucket_path(operands[0])
+        if not os.path.isfile(path):
+            print('No URLs matched: %s' % operands[0])
+            return 1
+        with open(path, 'rb') as source_file:
+            md5 = hashlib.md5(source_file.read()).digest()
+        print('%s:' % operands[0])
+        print('    Content-Length:         %i' % os.path.getsize(path))
+        print('    Hash (md5):             %s' % base64.b64encode(md5).decode())
+        return 0
+    sys.stderr.write('Unsupported gsutil command %s\n' % command)
+    return 1
+
+
+def fake_codesign(args):
+    '''codesign -f -s <identity> [options] <path>...'''
+    paths = []
+    entitlements = None
+    runtime = timestamp = False
+    index = 0
+    while index < len(args):
+        arg = args[index]
+        if arg in ('-s', '--entitlements', '--options'):
+            if arg == '--entitlements':
+                with open(args[index + 1], 'rb') as plist:
+                    entitlements = plist.read()
+            runtime |= arg == '--options' and args[index + 1] == 'runtime'
+            index += 2
+            continue
+        runtime |= arg == '--options=runtime'
+        timestamp |= arg == '--timestamp'
+        if not arg.startswith('-'):
+            paths.append(arg)
+        index += 1
+    for path in paths:
+        if simulate('codesign'):
+            sys.stderr.write('%s: simulated timestamp service failure\n' % path)
+            return 1
+        signature = code_signature(
+            os.path.basename(path), entitlements, runtime, timestamp)
+        sign_fake_binary(path, signature)
+    return 0
+
+
+def blob(magic, payload):
+    '''Returns a code signing blob, magic and length ahead of payload'''
+    return struct.pack('>II', magic, 8 + len(payload)) + payload
+
+
+def code_signature(identifier, entitlements, runtime, timestamp, adhoc=False):
+    '''Returns an embedded signature superblob like codesign writes, with a
+    code directory lacking page hashes'''
+    identifier = identifier.encode() + b'\0'
+    flags = (CS_RUNTIME if runtime else 0) | (CS_ADHOC if adhoc else 0)
+    code_directory = struct.pack(
+        '>7I4BI', 0x20400, flags, 44 + len(identifier), 44, 0, 0, 0, 32, 2, 0, 12, 0)
+    blobs = [(0, blob(0xfade0c02, code_directory + identifier))]
+    if entitlements is not None:
+        blobs.append((5, blob(0xfade7171, entitlements)))
+    if adhoc:
+        cms = b''
+    else:
+        cms = FAKE_CMS + (FAKE_TIMESTAMP if timestamp else b'')
+    blobs.append((0x10000, blob(0xfade0b01, cms)))
+    index = b''
+    offset = 12 + 8 * len(blobs)
+    for slot, data in blobs:
+        index += struct.pack('>II', slot, offset)
+        offset += len(data)
+    return struct.pack('>III', 0xfade0cc0, offset, len(blobs)) + index \
+        + b''.join(data for _, data in blobs)
+
+
+def sign_slice(data, signature):
+    '''Returns a thin Mach-O binary carrying signature, replacing any
+    earlier one as codesign -f does'''
+    ncmds, = struct.unpack_from('<I', data, 16)
+    if ncmds:
+        data = data[:struct.unpack_from('<I', data, 40)[0]]
+    data += bytes(-len(data) % 16)
+    command = struct.pack('<4I', LC_CODE_SIGNATURE, 16, len(data), len(signature))
+    return data[:16] + struct.pack('<II', 1, 16) + data[24:32] + command \
+        + data[32 + len(command):] + signature
+
+
+def sign_fake_binary(path, signature):
+    '''Sign every slice of a thin or fat binary written by fake_binary'''
+    with open(path, 'rb') as binary:
+        data = binary.read()
+    magic, count = struct.unpack_from('>II', data)
+    if magic == FAT_MAGIC:
+        slices = []
+        for index in range(count):
+            _, _, offset, size, _ = struct.unpack_from('>iiIII', data, 8 + 20 * index)
+            slices.append(sign_slice(data[offset:offset + size], signature))
+        data = fat_binary(slices)
+    else:
+        data = sign_slice(data, signature)
+    with open(path, 'wb') as binary:
+        binary.write(data)
+
+
+def notary_request_status(state_dir, request_uuid):
+    '''Returns the status of a fake notary submission and when it was made'''
+    with open(os.path.join(state_dir, request_uuid)) as request:
+        submitted_at = float(request.read())
+    status = 'in progress'
+    if time.time() - submitted_at >= env_float('BENCH_NOTARY_SECONDS'):
+        status = 'success'
+    return status, submitted_at
+
+
+def fake_xcrun(args):
+    '''xcrun altool --notarize-app ... | --notarization-info <uuid> ... |
+    --notarization-history <page> ... --output-format xml'''
+    state_dir = os.environ['BENCH_STATE']
+    if '--notarize-app' in args:
+        if simulate('notary_submit'):
+            print('*** Error: simulated upload failure')
+            return 1
+        request_uuid = str(uuid.uuid4())
+        with open(os.path.join(state_dir, request_uuid), 'w') as request:
+            request.write(str(time.time()))
+        print('No errors uploading.\nRequestUUID = %s' % request_uuid)
+        return 0
+    if '--notarization-info' in args:
+        request_uuid = args[args.index('--notarization-info') + 1]
+        if simulate('notary_status'):
+            print('*** Error: simulated status failure')
+            return 1
+        status, _ = notary_request_status(state_dir, request_uuid)
+        print('   RequestUUID: %s\n        Status: %s' % (request_uuid, status))
+        return 0
+    if '--notarization-history' in args:
+        page = int(args[args.index('--notarization-history') + 1])
+        if simulate('notary_status'):
+            print('*** Error: simulated history failure')
+            return 1
+        requests = []
+        for request_uuid in os.listdir(state_dir):
+            status, submitted_at = notary_request_status(state_dir, request_uuid)
+            requests.append((submitted_at, request_uuid, status))
+        # Most recent first, in pages like the notary service
+        items = [
+            {
+                'Date': datetime.datetime.fromtimestamp(
+                    submitted_at, datetime.timezone.utc).replace(tzinfo=None),
+                'RequestUUID': request_uuid,
+                'Status': status,
+                }
+            for submitted_at, request_uuid, status in sorted(requests, reverse=True)]
+        pages = max(1, -(-len(items) // NOTARY_HISTORY_PAGE_SIZE))
+        history = {
+            'items': items[page * NOTARY_HISTORY_PAGE_SIZE:(page + 1) * NOTARY_HISTORY_PAGE_SIZE],
+            'firstPage': 0,
+            'lastPage': pages - 1,
+            }
+        if page + 1 < pages:
+            history['nextPage'] = page + 1
+        sys.stdout.write(plistlib.dumps({
+            'notarization-history': history,
+            'success-message': 'No errors getting notarization history.',
+            }).decode())
+        return 0
+    sys.stderr.write('Unsupported xcrun invocation %s\n' % ' '.join(args))
+    return 1
+
+
+def write_member(archive, info, destination):
+    '''Extract a zip member, restoring symlinks and modes like unzip does'''
+    path = os.path.join(destination, info.filename)
+    mode = info.external_attr >> 16
+    if info.is_dir():
+        os.makedirs(path, exist_ok=True)
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if stat.S_ISLNK(mode):
+        os.symlink(archive.read(info).decode(), path)
+        return
+    with archive.open(info) as source, open(path, 'wb') as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+    if mode & 0o7777:
+        os.chmod(path, mode & 0o7777)
+
+
+def fake_unzip(args):
+    '''unzip <archive> -d <directory> | unzip -l <archive>'''
+    if simulate('unzip'):
+        return 1
+    if args[0] == '-l':
+        with zipfile.ZipFile(args[1]) as archive:
+            for info in archive.infolist():
+                print('%9d  %s' % (info.file_size, info.filename))
+        return 0
+    destination = args[args.index('-d') + 1]
+    with zipfile.ZipFile(args[0]) as archive:
+        for info in archive.infolist():
+            write_member(archive, info, destination)
+    return 0
+
+
+def fake_zip(args):
+    '''zip --symlinks -r -u <archive> . -i *, run from the directory to add'''
+    if simulate('zip'):
+        return 1
+    operands = [arg for arg in args if not arg.startswith('-')]
+    destination = os.path.abspath(operands[0])
+    updates = {}
+    for dirpath, dirnames, filenames in os.walk('.'):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            arcname = os.path.relpath(path, '.')
+            if os.path.isdir(path) and not os.path.islink(path):
+                arcname += '/'
+            updates[arcname] = path
+    rewritten = destination + '.fake_zip'
+    with zipfile.ZipFile(destination) as source, \
+            zipfile.ZipFile(rewritten, 'w', zipfile.ZIP_DEFLATED) as target:
+        for info in source.infolist():
+            path = updates.get(info.filename)
+            if path is None or os.path.getmtime(path) <= time.mktime(info.date_time + (0, 0, -1)):
+                updates.pop(info.filename, None)
+                target.writestr(info, source.read(info))
+        for arcname, path in sorted(updates.items()):
+            info = zipfile.ZipInfo.from_file(path, arcname)
+            if os.path.islink(path):
+                info.external_attr = (stat.S_IFLNK | 0o777) << 16
+                target.writestr(info, os.readlink(path))
+            elif arcname.endswith('/'):
+                target.writestr(info, b'')
+            else:
+                with open(path, 'rb') as source_file:
+                    target.writestr(info, source_file.read(), zipfile.ZIP_DEFLATED)
+    os.replace(rewritten, destination)
+    return 0
+
+
+def run_fake(tool, args):
+    '''Entry point of the shims on PATH'''
+    return {
+        'codesign': fake_codesign,
+        'gsutil': fake_gsutil,
+        'unzip': fake_unzip,
+        'xcrun': fake_xcrun,
+        'zip': fake_zip,
+        }[tool](args)
+
+
+def write_shims(bin_dir):
+    '''Write an executable shim per fake tool into bin_dir'''
+    for tool in FAKE_TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, 'w') as shim:
+            shim.write('#!%s\n' % sys.executable)
+            shim.write('import sys\n')
+            shim.write('sys.path.insert(0, %r)\n' % HERE)
+            shim.write('import benchmark\n')
+            shim.write('sys.exit(benchmark.run_fake(%r, sys.argv[1:]))\n' % tool)
+        os.chmod(path, 0o755)
+
+
+def synthetic_bytes(rng, size):
+    '''Returns size bytes that deflate roughly in half, like real binaries'''
+    block = 4096
+    chunks = []
+    for _ in range(0, size, block):
+        chunks.append(rng.randbytes(block // 2) + bytes(block // 2))
+    return b''.join(chunks)[:size]
+
+
+def thin_binary(rng, cputype, filetype, size):
+    '''Returns an unsigned 64-bit Mach-O binary of about size bytes'''
+    header = struct.pack('<8I', MH_MAGIC_64, cputype, 0, filetype, 0, 0, 0, 0)
+    header += bytes(LOAD_COMMAND_SPACE)
+    return header + synthetic_bytes(rng, max(0, size - len(header)))
+
+
+def fat_binary(slices, magic=FAT_MAGIC):
+    '''Returns a fat binary of the given Mach-O slices, with 64-bit offsets
+    if magic is FAT_MAGIC_64'''
+    entry = '>iiIII' if magic == FAT_MAGIC else '>iiQQII'
+    header = struct.pack('>II', magic, len(slices))
+    body = b''
+    offset = len(header) + struct.calcsize(entry) * len(slices)
+    for data in slices:
+        padding = -offset % (1 << FAT_ALIGN)
+        body += bytes(padding) + data
+        offset += padding
+        cputype, cpusubtype = struct.unpack_from('<ii', data, 4)
+        fields = [cputype, cpusubtype, offset, len(data), FAT_ALIGN]
+        if magic == FAT_MAGIC_64:
+            fields.append(0)
+        header += struct.pack(entry, *fields)
+        offset += len(data)
+    return header + body
+
+
+def fake_binary(rng, name, size):
+    '''Returns an unsigned binary of about size bytes, dylibs being thin and
+    executables fat with x86_64 and arm64 slices'''
+    if name.endswith('.dylib'):
+        return thin_binary(rng, CPU_TYPE_ARM64, MH_DYLIB, size)
+    return fat_binary([
+        thin_binary(rng, cputype, MH_EXECUTE, size // 2)
+        for cputype in [CPU_TYPE_X86_64, CPU_TYPE_ARM64]])
+
+
+def write_synthetic_zip(target, config, rng, binary_bytes, filler_bytes, unlisted=0):
+    '''Write a zip with every file in config, plus unsigned filler files and
+    unlisted dylibs'''
+    with zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED) as archive:
+        written = set()
+        for entry in config.get('files', []) + config.get('files_with_entitlements', []):
+            name = entry['path'] if isinstance(entry, dict) else entry
+            if name in written:
+                continue
+            written.add(name)
+            if isinstance(entry, dict):
+                with tempfile.SpooledTemporaryFile() as nested:
+                    write_synthetic_zip(
+                        nested, entry, rng, binary_bytes, filler_bytes, unlisted)
+                    nested.seek(0)
+                    info = zipfile.ZipInfo(name, SYNTHETIC_DATE_TIME)
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    archive.writestr(info, nested.read())
+                continue
+            info = zipfile.ZipInfo(name, SYNTHETIC_DATE_TIME)
+            info.external_attr = (stat.S_IFREG | 0o755) << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            archive.writestr(info, fake_binary(rng, name, binary_bytes))
+        for index in range(unlisted):
+            name = 'lib/unlisted_%i.dylib' % index
+            info = zipfile.ZipInfo(name, SYNTHETIC_DATE_TIME)
+            info.external_attr = (stat.S_IFREG | 0o644) << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            archive.writestr(info, fake_binary(rng, name, binary_bytes))
+        filler_count = 4
+        for index in range(filler_count):
+            info = zipfile.ZipInfo('resources/data_%i.bin' % index, SYNTHETIC_DATE_TIME)
+            info.external_attr = (stat.S_IFREG | 0o644) << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            archive.writestr(info, synthetic_bytes(rng, filler_bytes // filler_count))
+        link = zipfile.ZipInfo('resources/current', SYNTHETIC_DATE_TIME)
+        link.external_attr = (stat.S_IFLNK | 0o777) << 16
+        archive.writestr(link, 'data_0.bin')
+
+
+def generate_archives(bucket, revision, binary_bytes, filler_bytes, seed, unlisted=0):
+    '''Write a synthetic copy of every entry of ARCHIVES, returns total bytes'''
+    import codesign
+    rng = random.Random(seed)
+    total = 0
+    for config in codesign.ARCHIVES:
+        path = os.path.join(bucket, BUCKET_PREFIX, 'flutter', revision, config['path'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as target:
+            write_synthetic_zip(target, config, rng, binary_bytes, filler_bytes, unlisted)
+        total += os.path.getsize(path)
+    return total
+
+
+def read_proc_io(pid):
+    '''Returns dict of the fields of /proc/<pid>/io, empty once it has exited'''
+    fields = {}
+    try:
+        with open('/proc/%i/io' % pid) as proc_io:
+            for line in proc_io:
+                key, value = line.split(':')
+                fields[key] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return fields
+
+
+def run_codesign(run_dir, env, arguments, log_path):
+    '''Run codesign.py to completion, returns dict of measurements'''
+    command = [sys.executable, os.path.join(HERE, 'codesign.py')] + arguments
+    started_at = time.time()
+    with open(log_path, 'w') as log_file:
+        proc = subprocess.Popen(
+            command,
+            cwd=run_dir,
+            env=env,
+            stdout=log_file,
+            stderr=subprocess.STDOUT)
+        io_fields = {}
+        while True:
+            io_fields = read_proc_io(proc.pid) or io_fields
+            # wait4 rather than Popen.wait, for the child's resource usage
+            pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                break
+            time.sleep(0.05)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return {
+        'exit_code': proc.returncode,
+        'wall_seconds': round(time.time() - started_at, 3),
+        # Covers codesign.py and the tools it waited on, in kilobytes on Linux
+        'peak_rss_kb': usage.ru_maxrss,
+        'bytes_written': io_fields.get('wchar', 0),
+        'disk_bytes_written': io_fields.get('write_bytes', 0),
+        }
+
+
+def summarize(result, notary_submissions):
+    '''Report fields of a single codesign.py run'''
+    return {
+        'notary_submissions': notary_submissions,
+        'exit_code': result['exit_code'],
+        'wall_seconds': result['wall_seconds'],
+        'peak_rss_mb': round(result['peak_rss_kb'] / 1024.0, 1),
+        'bytes_written': result['bytes_written'],
+        'disk_bytes_written': result['disk_bytes_written'],
+        }
+
+
+def main():
+    '''Harness entrypoint'''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--revision', nargs='+', default=['0' * 40],
+                        help='revisions to sign in one run, each with its own '
+                        'synthetic archives')
+    parser.add_argument('--binary-mb', type=float, default=4,
+                        help='size of each binary to sign')
+    parser.add_argument('--filler-mb', type=float, default=8,
+                        help='size of the unsigned files in each zip')
+    parser.add_argument('--unlisted-dylibs', type=int, default=0,
+                        help='dylibs missing from ARCHIVES added to each zip')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--notary-seconds', type=float, default=2,
+                        help='time before a submission reports success')
+    for tool in FAKE_TOOLS + ['notary_submit', 'notary_status']:
+        if tool == 'xcrun':
+            continue
+        parser.add_argument('--%s-latency' % tool.replace('_', '-'), type=float, default=0,
+                            help='seconds each %s call takes' % tool)
+        parser.add_argument('--%s-failure-rate' % tool.replace('_', '-'), type=float, default=0,
+                            help='fraction of %s calls that fail' % tool)
+    parser.add_argument('--storage', choices=['gsutil', 'local'], default='gsutil',
+                        help='storage backend of codesign.py, "local" skips the '
+                        'gsutil processes entirely')
+    parser.add_argument('--rerun-revision',
+                        help='afterwards, sign identical archives for this '
+                        'revision too, to measure incremental signing')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the temporary directory for inspection')
+    parser.add_argument('--output', help='also write the report to this file')
+    parser.add_argument('codesign_args', nargs='*',
+                        help='extra arguments for codesign.py, after --')
+    options = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='codesign_benchmark.')
+    bucket = os.path.join(root, 'bucket')
+    bin_dir = os.path.join(root, 'bin')
+    state_dir = os.path.join(root, 'state')
+    run_dir = os.path.join(root, 'run')
+    for dirname in [bucket, bin_dir, state_dir, run_dir]:
+        os.makedirs(dirname)
+    shutil.copyfile(
+        os.path.join(HERE, 'Entitlements.plist'),
+        os.path.join(run_dir, 'Entitlements.plist'))
+    write_shims(bin_dir)
+
+    print('Generating synthetic archives in %s...' % bucket)
+    input_bytes = 0
+    for index, revision in enumerate(options.revision):
+        input_bytes += generate_archives(
+            bucket,
+            revision,
+            int(options.binary_mb * 1024 * 1024),
+            int(options.filler_mb * 1024 * 1024),
+            options.seed + index,
+            options.unlisted_dylibs)
+
+    env = dict(os.environ)
+    env.update({
+        'PATH': bin_dir + os.pathsep + env.get('PATH', ''),
+        'BENCH_BUCKET': bucket,
+        'BENCH_STATE': state_dir,
+        'BENCH_NOTARY_SECONDS': str(options.notary_seconds),
+        'APP_SPECIFIC_PASSWORD': 'benchmark',
+        'CODESIGN_USERNAME': 'benchmark@example.com',
+        'CODESIGN_CERT_NAME': 'Benchmark Developer ID',
+        })
+    for tool in FAKE_TOOLS + ['notary_submit', 'notary_status']:
+        option = tool.replace('-', '_')
+        for suffix in ['latency', 'failure_rate']:
+            value = getattr(options, '%s_%s' % (option, suffix), None)
+            if value is not None:
+                env['BENCH_%s_%s' % (tool.upper(), suffix.upper())] = str(value)
+
+    common_arguments = FAST_POLLING + [
+        '--sign-cache-dir', os.path.join(root, 'sign_cache'),
+        '--storage', options.storage,
+        ]
+    if options.storage == 'local':
+        common_arguments += ['--storage-root', bucket]
+    common_arguments += options.codesign_args
+    arguments = options.revision + common_arguments
+    print('Running codesign.py %s...' % ' '.join(arguments))
+    log_path = os.path.join(root, 'codesign_output.txt')
+    result = run_codesign(run_dir, env, arguments, log_path)
+
+    report = summarize(result, len(os.listdir(state_dir)))
+    report['input_bytes'] = input_bytes
+    report['arguments'] = arguments
+    if options.rerun_revision and result['exit_code'] == 0:
+        generate_archives(
+            bucket,
+            options.rerun_revision,
+            int(options.binary_mb * 1024 * 1024),
+            int(options.filler_mb * 1024 * 1024),
+            options.seed,
+            options.unlisted_dylibs)
+        submissions = len(os.listdir(state_dir))
+        print('Running codesign.py again for %s...' % options.rerun_revision)
+        result = run_codesign(
+            run_dir,
+            env,
+            [options.rerun_revision] + common_arguments,
+            log_path)
+        report['rerun'] = summarize(
+            result,
+            len(os.listdir(state_dir)) - submissions)
+    print(json.dumps(report, indent=1))
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=1)
+
+    if options.keep or result['exit_code'] != 0:
+        print('Output of codesign.py is in %s' % log_path)
+    else:
+        shutil.rmtree(root)
+    return result['exit_code']
+
+
+if __name__ == '__main__':
+    sys.exit(main())
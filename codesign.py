@@ -1,13 +1,41 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 '''Hello world'''
 
+import asyncio
+import atexit
+import base64
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import heapq
+import http.server
+import io
+import itertools
 import json
 import os
+import plistlib
 import re
 import shutil
+import signal
+import stat
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
 import time
+import xml.parsers.expat
+import zipfile
+import zlib
+
+# Optional, storage falls back to gsutil without it
+try:
+    from google.api_core import exceptions as gcs_exceptions
+    from google.cloud import storage as gcs
+except ImportError:
+    gcs = None
 
 ARCHIVES = [
     {
@@ -213,15 +241,365 @@ ARCHIVES = [
         },
 ]
 
+# Archives of the iOS USB dependencies, signed with --<name> <revision>
+LIBIMOBILEDEVICE_ARCHIVES = {
+    'ios-deploy': {
+        'path': 'ios-deploy.zip',
+        'files': ['ios-deploy'],
+        },
+    'libimobiledevice': {
+        'path': 'libimobiledevice.zip',
+        'files_with_entitlements': [
+            'idevicescreenshot',
+            'idevicesyslog',
+            'libimobiledevice-1.0.6.dylib',
+            ],
+        },
+    'libplist': {
+        'path': 'libplist.zip',
+        'files_with_entitlements': [
+            'libplist-2.0.3.dylib',
+            ],
+        },
+    'usbmuxd': {
+        'path': 'usbmuxd.zip',
+        'files_with_entitlements': [
+            'iproxy',
+            'libusbmuxd-2.0.6.dylib',
+            ],
+        },
+    'openssl': {
+        'path': 'openssl.zip',
+        'files_with_entitlements': [
+            'libssl.1.1.dylib',
+            'libcrypto.1.1.dylib',
+            ],
+        },
+    }
+
 CWD = os.getcwd()
 
-LOG = []
+# Records buffered by the logger before it flushes, and the longest it
+# holds on to a record
+LOG_BUFFER_RECORDS = 500
+LOG_FLUSH_SECONDS = 2
 
 STARTING_TIME = int(time.time())
 
+# Positional arguments of the run, set from the command line
+ARGS = []
+
+# Stages an archive passes through, in order
+PIPELINE_STAGES = [
+    'download',
+    'extract',
+    'sign',
+    'repackage',
+    'notarize',
+    'upload',
+    ]
+
+# Command line options, may be overridden by parse_options()
+OPTIONS = {
+    # Default concurrency of every pipeline stage
+    'jobs': 4,
+    # Per-stage overrides, None falls back to jobs
+    'download_jobs': None,
+    'extract_jobs': None,
+    'sign_jobs': None,
+    'repackage_jobs': None,
+    'notarize_jobs': None,
+    'upload_jobs': None,
+    # Fewest binaries per codesign call when a group is split over the sign
+    # jobs. Timestamping takes a round trip per binary, which parallel calls
+    # overlap, so by default a group is spread over every sign job
+    'sign_min_batch': 1,
+    # Seconds to wait after submission before the first status check, so we
+    # never check for a job before it has been started
+    'notary_initial_delay': 45,
+    # Seconds between status checks of a single request, grows by
+    # NOTARY_BACKOFF_FACTOR up to notary_max_poll_interval
+    'notary_poll_interval': 20,
+    'notary_max_poll_interval': 120,
+    # Seconds after submission at which a request is given up on
+    'notary_deadline': 3600,
+    # Global cap on status checks across all requests
+    'notary_checks_per_minute': 30,
+    # Read the status of all pending requests from one notarization history
+    # query, checking requests it lacks one by one
+    'notary_history': True,
+    # "selective" extracts only the configured members of each zip in
+    # process, "full" unzips the whole archive
+    'extract_mode': 'selective',
+    # Persistent cache of signed binaries, keyed by their unsigned contents
+    'sign_cache_dir': os.path.join(os.getcwd(), 'sign_cache'),
+    # Size cap of the signing cache in megabytes, 0 disables the cache
+    'sign_cache_mb': 4096,
+    # Nested zips are rebuilt in memory, spilling to a temporary file past
+    # this many megabytes
+    'nested_zip_memory_mb': 256,
+    # Name of, or path to, an earlier session directory to resume
+    'resume': '',
+    # Cloud storage backend, one of "auto", "gcs", "gsutil" or "local"
+    'storage': 'auto',
+    # Directory standing in for gs:// with the local backend
+    'storage_root': '',
+    # Index of archives notarized by earlier runs, whose outputs are copied
+    # rather than signed again when their input is unchanged, '' disables it
+    'signed_index': os.path.join(os.getcwd(), 'signed_index.json'),
+    # Submit all signed archives to the notary service in a single container
+    # zip rather than one request per archive
+    'batch_notarize': False,
+    # Keep running, taking signing jobs over HTTP on localhost
+    'daemon': False,
+    'daemon_port': 8765,
+    # Jobs the daemon runs at once, all sharing the same pools
+    'daemon_jobs': 2,
+    # Check the code signature of every signed binary before notarizing
+    'verify_signatures': True,
+    # What to do about Mach-O binaries found in a zip but missing from its
+    # config, one of UNLISTED_BINARY_MODES
+    'unlisted_binaries': 'report',
+    # Cap in megabytes on the disk taken by archives being processed, new
+    # downloads wait while it would be exceeded, 0 disables it
+    'disk_budget_mb': 0,
+    # Directory for extracted binaries, such as a tmpfs mount, '' keeps them
+    # next to their archive
+    'staging_dir': '',
+    }
+
+UNLISTED_BINARY_MODES = ['ignore', 'report', 'sign', 'fail']
+
+# Stages recorded in the session journal, in order
+JOURNAL_STAGES = [
+    'downloaded',
+    'signed',
+    'repackaged',
+    'submitted',
+    'notarized',
+    'uploaded',
+    ]
+
+NOTARY_BACKOFF_FACTOR = 1.5
+# Pages of the notarization history read before a request missing from
+# them is checked on its own
+NOTARY_HISTORY_MAX_PAGES = 5
+
+# Seconds after which each external tool is killed
+COMMAND_TIMEOUTS = {
+    'altool': 30 * 60,
+    'codesign': 10 * 60,
+    'gsutil': 60 * 60,
+    'unzip': 30 * 60,
+    'zip': 30 * 60,
+    }
+COMMAND_DEFAULT_TIMEOUT = 60 * 60
+# Bytes of a command's output kept, split between its start and end
+COMMAND_OUTPUT_LIMIT = 64 * 1024
+
+# Mach-O and code signature structures, see <mach-o/loader.h>,
+# <mach-o/fat.h> and <kern/cs_blobs.h>. Mach-O magic read little endian maps
+# to (byte order, header size), fat headers are always big endian.
+MACHO_MAGICS = {
+    0xfeedface: ('<', 28),
+    0xfeedfacf: ('<', 32),
+    0xcefaedfe: ('>', 28),
+    0xcffaedfe: ('>', 32),
+    }
+FAT_MAGIC = 0xcafebabe
+FAT_MAGIC_64 = 0xcafebabf
+FAT_ARCH = struct.Struct('>iiIII')
+FAT_ARCH_64 = struct.Struct('>iiQQII')
+CPU_TYPES = {
+    7: 'i386',
+    12: 'arm',
+    0x1000007: 'x86_64',
+    0x100000c: 'arm64',
+    }
+LC_CODE_SIGNATURE = 0x1d
+CSMAGIC_EMBEDDED_SIGNATURE = 0xfade0cc0
+CSMAGIC_CODEDIRECTORY = 0xfade0c02
+CSMAGIC_EMBEDDED_ENTITLEMENTS = 0xfade7171
+CSMAGIC_BLOBWRAPPER = 0xfade0b01
+CSSLOT_CODEDIRECTORY = 0
+CSSLOT_ENTITLEMENTS = 5
+CSSLOT_SIGNATURESLOT = 0x10000
+CS_ADHOC = 0x2
+CS_RUNTIME = 0x10000
+# Java class files share the fat magic, and have a version where a fat
+# header has its number of architectures, always well above this
+FAT_MAX_ARCHS = 30
+ZIP_MAGICS = [b'PK\x03\x04', b'PK\x05\x06']
+# DER encoded id-aa-timeStampToken, 1.2.840.113549.1.9.16.2.14, present in
+# the CMS signature once a secure timestamp was added
+TIMESTAMP_TOKEN_OID = b'\x06\x0b\x2a\x86\x48\x86\xf7\x0d\x01\x09\x10\x02\x0e'
+
+# Disk an archive takes while it is processed, in multiples of its size: the
+# download, the extracted binaries and the rebuilt copy
+ARCHIVE_FOOTPRINT_FACTOR = 3
+
+# Files past this many megabytes are uploaded in parallel parts
+PARALLEL_UPLOAD_THRESHOLD_MB = 150
+PARALLEL_UPLOAD_CHUNK_MB = 32
+
+# Zip records, see section 4.3 of PKWARE's APPNOTE.TXT
+ZIP_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+ZIP_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+ZIP_CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+ZIP_CENTRAL_HEADER_SIGNATURE = b'PK\x01\x02'
+ZIP_END_RECORD = struct.Struct('<4s4H2LH')
+ZIP_END_RECORD_SIGNATURE = b'PK\x05\x06'
+ZIP_DATA_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+ZIP_FLAG_DATA_DESCRIPTOR = 0x08
+ZIP_FLAG_UTF8 = 0x800
+# Archives beyond these limits need zip64 records, left to the zip tool
+ZIP_MAX_SIZE = 0xffffffff
+ZIP_MAX_ENTRIES = 0xffff
+
+# Digests of every file downloaded, extracted or written, see record_digests()
+MANIFEST = []
+MANIFEST_LOCK = threading.Lock()
+
+# Set by main()
+PIPELINE = None
+SIGN_CACHE = None
+SIGN_EXECUTOR = None
+STORAGE = None
+SIGNED_INDEX = None
+UPLOADS = None
+JOURNAL = None
+WORKING_SET = None
+NOTARY_HISTORY = None
+NOTARY_CHECKS = None
+STAGING_DIR = None
+# Set once the run has failed, so archives in flight stop at their next stage
+STOP = threading.Event()
+# Set by serve() while running as a daemon
+JOBS = None
+# Commands running, each in its own process group, see kill_commands()
+COMMANDS = set()
+COMMANDS_LOCK = threading.Lock()
+LOGGER = None
+LOGGER_LOCK = threading.Lock()
+LOG_CONTEXT = threading.local()
+
+
+class StreamingLogger(object):
+    '''Writes log records as JSON lines to the logs dir as the run goes.
+
+    Records go to log.jsonl, and also to archives/<archive>.jsonl when they
+    carry an archive context field. At most LOG_BUFFER_RECORDS records are
+    held in memory; the buffer is flushed when full, every
+    LOG_FLUSH_SECONDS from a background thread, and at exit. Safe to use
+    from any thread.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.main_sink = os.path.join(directory, 'log.jsonl')
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self.flush_periodically)
+        self.flusher.daemon = True
+        self.flusher.start()
+        atexit.register(self.flush)
+
+    def sink_for(self, archive):
+        '''Returns path of the per-archive sink, archive being prefixed by
+        its revision where known'''
+        return os.path.join(
+            self.directory,
+            'archives',
+            '%s.jsonl' % get_unique_filename(archive))
+
+    def write(self, record):
+        '''Buffer a record, flushing if the buffer is full'''
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self.lock:
+            sink = record.get('archive')
+            if sink is not None and 'revision' in record:
+                sink = '%s/%s' % (record['revision'], sink)
+            self.buffer.append((sink, line))
+            if len(self.buffer) >= LOG_BUFFER_RECORDS:
+                self.flush_locked()
+
+    def flush(self):
+        '''Append buffered records to their sinks'''
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        '''flush() for callers already holding the lock'''
+        if not self.buffer:
+            return
+        sinks = collections.OrderedDict()
+        sinks[self.main_sink] = []
+        for archive, line in self.buffer:
+            sinks[self.main_sink].append(line)
+            if archive is not None:
+                sinks.setdefault(self.sink_for(archive), []).append(line)
+        del self.buffer[:]
+        for path, lines in sinks.items():
+            dirname = os.path.dirname(path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(path, 'a') as sink:
+                sink.write(''.join(lines))
+
+    def flush_periodically(self):
+        '''Flusher thread body'''
+        while not self.stopped.wait(LOG_FLUSH_SECONDS):
+            self.flush()
+
+    def close(self, filename):
+        '''Flush, stop the flusher and move the main sink to filename
+
+        Records other threads log afterwards are appended to filename,
+        flushed when the buffer fills and at exit.
+        '''
+        self.stopped.set()
+        with self.lock:
+            self.flush_locked()
+            if self.main_sink == filename:
+                return
+            if os.path.isfile(self.main_sink):
+                os.replace(self.main_sink, filename)
+            self.main_sink = filename
+
+
+def get_logger():
+    '''Returns the logger, creating it on first use'''
+    global LOGGER
+    with LOGGER_LOCK:
+        if LOGGER is None:
+            LOGGER = StreamingLogger(get_logs_dir())
+        return LOGGER
+
+
+@contextlib.contextmanager
+def log_context(**fields):
+    '''Add fields, e.g. archive, to every record logged by this thread'''
+    saved = getattr(LOG_CONTEXT, 'fields', {})
+    LOG_CONTEXT.fields = dict(saved, **fields)
+    try:
+        yield
+    finally:
+        LOG_CONTEXT.fields = saved
+
+
+def with_log_context(func):
+    '''Wrap func to run with the calling thread's log context, for executors'''
+    fields = getattr(LOG_CONTEXT, 'fields', {})
+
+    def wrapped(*args):
+        with log_context(**fields):
+            return func(*args)
+    return wrapped
+
 
 def log(str_or_list, output_logfile=None):
-    '''Print to stdout and append to LOG list'''
+    '''Print to stdout and stream to the log'''
     message = ''
     if isinstance(str_or_list, list):
         message = ''.join(str_or_list)
@@ -230,56 +608,326 @@ def log(str_or_list, output_logfile=None):
     else:
         log_and_exit('Unknown entity "%s" passed to log' % str_or_list)
     if output_logfile is None:
-        LOG.append(message)
+        record = {'time': time.time(), 'message': message}
+        record.update(getattr(LOG_CONTEXT, 'fields', {}))
+        get_logger().write(record)
         print(message)
     # This is used for logging out zip contents
     else:
         dirname = os.path.dirname(output_logfile)
         if not os.path.isdir(dirname):
-            os.mkdir(dirname)
+            os.makedirs(dirname, exist_ok=True)
         with open(output_logfile, 'w') as logfile:
             logfile.write(message)
 
 
-def write_log_to_file(filename, should_append=False):
-    '''Write everything in LOG to given file, then clear LOG'''
-    mode = 'w'
-    if should_append:
-        mode = 'w+'
-    with open(filename, mode) as logfile:
-        if should_append:
-            logfile.write('\n - NEW LOG - \n')
-        logfile.write('\n'.join(LOG))
-    del LOG[:]
+def write_log_to_file(filename):
+    '''Flush the log, which is then found at given file'''
+    get_logger().close(filename)
 
 
 def log_and_exit(message, exit_code=1, file_name='crasher.log'):
     '''Flush log then exit'''
     log(message)
+    if JOBS is not None:
+        # Only the current daemon job fails, the log carries on
+        exit(exit_code)
+    STOP.set()
+    write_manifest(os.path.join(get_logs_dir(), 'manifest.json'))
+    METRICS.write(get_logs_dir())
     write_log_to_file(os.path.join(get_logs_dir(), file_name))
     exit(exit_code)
 
 
-def shasum(path_to_file):
-    '''log out the shasum of a file'''
-    sha = run_and_return_output(['shasum', path_to_file])
-    log(sha)
-    return sha
-
-
-class Cd(object):
-    """Context manager for changing the current working directory"""
-
-    def __init__(self, newPath):
-        self.new_path = os.path.expanduser(newPath)
-        self.saved_path = ''
-
-    def __enter__(self):
-        self.saved_path = os.getcwd()
-        os.chdir(self.new_path)
+class HashingWriter(object):
+    '''Wraps a writable file, hashing everything written through it
+
+    With no target, data is only hashed. algorithms are names known to
+    hashlib, sha1 and sha256 by default as recorded in the manifest.
+    '''
+
+    def __init__(self, target=None, algorithms=('sha1', 'sha256')):
+        self.target = target
+        self.size = 0
+        self.hashes = [(name, hashlib.new(name)) for name in algorithms]
+
+    def write(self, data):
+        '''Hash then write data'''
+        self.size += len(data)
+        for _, digest in self.hashes:
+            digest.update(data)
+        if self.target is None:
+            return len(data)
+        return self.target.write(data)
+
+    def tell(self):
+        '''Position in the underlying file'''
+        return self.target.tell()
+
+    def digests(self):
+        '''Returns dict of size and hex digests of the data written so far'''
+        digests = {'size': self.size}
+        for name, digest in self.hashes:
+            digests[name] = digest.hexdigest()
+        return digests
+
+
+def hash_file(path, algorithms=('sha1', 'sha256')):
+    '''Returns dict of size and hex digests of a file, read in one pass'''
+    hasher = HashingWriter(algorithms=algorithms)
+    with open(path, 'rb') as source:
+        shutil.copyfileobj(source, hasher, 1024 * 1024)
+    return hasher.digests()
+
+
+def record_digests(path, digests, stage):
+    '''Log digests of a file in shasum format and add them to MANIFEST'''
+    entry = {'path': path, 'stage': stage}
+    entry.update(digests)
+    fields = getattr(LOG_CONTEXT, 'fields', {})
+    if 'job' in fields:
+        entry['job'] = fields['job']
+    with MANIFEST_LOCK:
+        MANIFEST.append(entry)
+    log('%s  %s' % (digests['sha1'], path))
+
+
+def shasum(path_to_file, stage):
+    '''Hash a file already on disk and record it in the manifest'''
+    digests = hash_file(path_to_file)
+    record_digests(path_to_file, digests, stage)
+    return digests['sha1']
+
+
+def write_manifest(filename, job=None):
+    '''Write MANIFEST as JSON to given file
+
+    Given a daemon job, only its entries are written, and are then dropped.
+    '''
+    with MANIFEST_LOCK:
+        entries = [
+            entry for entry in MANIFEST
+            if job is None or entry.get('job') == job]
+        with open(filename, 'w') as manifest_file:
+            json.dump(entries, manifest_file, indent=1)
+        if job is not None:
+            MANIFEST[:] = [entry for entry in MANIFEST if entry.get('job') != job]
+
+
+def percentile(values, fraction):
+    '''Nearest-rank percentile of a non-empty list'''
+    ordered = sorted(values)
+    rank = max(0, int(-(-fraction * len(ordered) // 1)) - 1)
+    return ordered[rank]
+
+
+def prometheus_labels(**labels):
+    '''Format labels for the Prometheus text exposition format'''
+    escaped = []
+    for key, value in sorted(labels.items()):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append('%s="%s"' % (key, value))
+    return '{%s}' % ','.join(escaped)
+
+
+class Metrics(object):
+    '''Wall-clock durations and byte counts per archive and stage.
+
+    The daemon job, revision and archive of each sample come from the log
+    context of the thread that recorded it. write() dumps a JSON summary and
+    a Prometheus textfile, with per-archive, per-stage totals, p50/p95 across
+    archives and the total time spent waiting on the notary. Each daemon job
+    is kept apart, '' being the samples taken outside of any job.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Per job, when its first sample started
+        self.started_at = {'': time.time()}
+        # Per job, (revision, archive, stage) to [seconds, bytes, count]
+        self.totals = {'': collections.OrderedDict()}
+
+    def add(self, stage, seconds, nbytes=0, archive=None, revision=None):
+        '''Record a sample'''
+        fields = getattr(LOG_CONTEXT, 'fields', {})
+        if archive is None:
+            archive = fields.get('archive', '')
+        if revision is None:
+            revision = fields.get('revision', '')
+        job = fields.get('job', '')
+        with self.lock:
+            self.started_at.setdefault(job, time.time() - seconds)
+            totals = self.totals.setdefault(job, collections.OrderedDict())
+            total = totals.setdefault((revision, archive, stage), [0.0, 0, 0])
+            total[0] += seconds
+            total[1] += nbytes
+            total[2] += 1
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        '''Time the enclosed block, yields a dict whose 'bytes' may be set'''
+        sample = {'bytes': 0}
+        started_at = time.time()
+        try:
+            yield sample
+        finally:
+            self.add(stage, time.time() - started_at, sample['bytes'])
+
+    def snapshot(self, job=''):
+        '''Returns a copy of the totals of job as a list of items'''
+        with self.lock:
+            return list(self.totals.get(job, {}).items())
+
+    def reset(self, job):
+        '''Drop everything recorded for job'''
+        with self.lock:
+            self.started_at.pop(job, None)
+            self.totals.pop(job, None)
+
+    def summary(self, job=''):
+        '''Returns the metrics of the run, or of a daemon job, as a dict
+
+        Archives are named by revision and path, as their log sinks are.
+        '''
+        archives = collections.OrderedDict()
+        stages = collections.OrderedDict()
+        for (revision, archive, stage), (seconds, nbytes, count) in self.snapshot(job):
+            if revision:
+                archive = '%s/%s' % (revision, archive)
+            archives.setdefault(archive, {})[stage] = {
+                'seconds': round(seconds, 3),
+                'bytes': nbytes,
+                'count': count,
+                }
+            stages.setdefault(stage, []).append((seconds, nbytes))
+        stage_summary = collections.OrderedDict()
+        for stage, samples in stages.items():
+            seconds = [sample[0] for sample in samples]
+            stage_summary[stage] = {
+                'archives': len(samples),
+                'seconds': round(sum(seconds), 3),
+                'bytes': sum(sample[1] for sample in samples),
+                'p50_seconds': round(percentile(seconds, 0.5), 3),
+                'p95_seconds': round(percentile(seconds, 0.95), 3),
+                }
+        notary_wait = stage_summary.get('notary_wait', {}).get('seconds', 0)
+        with self.lock:
+            started_at = self.started_at.get(job, time.time())
+        return {
+            'run_seconds': round(time.time() - started_at, 3),
+            'notary_wait_seconds': notary_wait,
+            'stages': stage_summary,
+            'archives': archives,
+            }
 
-    def __exit__(self, etype, value, traceback):
-        os.chdir(self.saved_path)
+    def write(self, directory, job=''):
+        '''Write metrics.json and metrics.prom, of the run or of a daemon job,
+        to directory'''
+        summary = self.summary(job)
+        with open(os.path.join(directory, 'metrics.json'), 'w') as metrics_file:
+            json.dump(summary, metrics_file, indent=1)
+        lines = [
+            '# HELP codesign_run_seconds Wall-clock duration of the run',
+            '# TYPE codesign_run_seconds gauge',
+            'codesign_run_seconds %s' % summary['run_seconds'],
+            '# HELP codesign_notary_wait_seconds Total time requests spent waiting on the notary',
+            '# TYPE codesign_notary_wait_seconds gauge',
+            'codesign_notary_wait_seconds %s' % summary['notary_wait_seconds'],
+            '# HELP codesign_stage_seconds Wall-clock seconds per archive and stage',
+            '# TYPE codesign_stage_seconds gauge',
+            ]
+        totals = self.snapshot(job)
+        for (revision, archive, stage), (seconds, _, _) in totals:
+            lines.append('codesign_stage_seconds%s %s' % (
+                prometheus_labels(archive=archive, revision=revision, stage=stage),
+                round(seconds, 3)))
+        lines += [
+            '# HELP codesign_stage_bytes Bytes handled per archive and stage',
+            '# TYPE codesign_stage_bytes gauge',
+            ]
+        for (revision, archive, stage), (_, nbytes, _) in totals:
+            lines.append('codesign_stage_bytes%s %s' % (
+                prometheus_labels(archive=archive, revision=revision, stage=stage),
+                nbytes))
+        lines += [
+            '# HELP codesign_stage_quantile_seconds Per-archive stage duration quantiles',
+            '# TYPE codesign_stage_quantile_seconds gauge',
+            ]
+        for stage, values in summary['stages'].items():
+            for quantile in ['p50', 'p95']:
+                lines.append('codesign_stage_quantile_seconds%s %s' % (
+                    prometheus_labels(stage=stage, quantile=quantile[1:]),
+                    values['%s_seconds' % quantile]))
+        with open(os.path.join(directory, 'metrics.prom'), 'w') as prom_file:
+            prom_file.write('\n'.join(lines) + '\n')
+
+
+METRICS = Metrics()
+
+
+def timed_function(stage):
+    '''Decorator recording each call's duration under stage'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            with METRICS.timed(stage):
+                return func(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+class Pipeline(object):
+    '''Bounded worker pools for each stage of archive processing.
+
+    Every archive runs on its own worker, and each stage it passes through
+    is guarded by that stage's semaphore, so archive N+1 can download while
+    archive N is being signed and archive N-1 is uploading to the notary.
+    '''
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.semaphores = {}
+        for name, limit in limits.items():
+            self.semaphores[name] = threading.BoundedSemaphore(limit)
+        # Enough workers that every stage can be saturated at once
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=sum(limits.values()))
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''Blocks until a slot in the given stage is free'''
+        with self.semaphores[name]:
+            yield
+
+    def submit(self, func, *args):
+        '''Schedule func(*args) in the current log context, returns a future'''
+        return self.executor.submit(with_log_context(func), *args)
+
+    def shutdown(self):
+        '''Wait for all scheduled work to finish'''
+        self.executor.shutdown(wait=True)
+
+    def abort(self):
+        '''Drop any work that has not started yet'''
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def stage_limits():
+    '''Returns dict of stage name to its configured concurrency'''
+    limits = {}
+    for name in PIPELINE_STAGES:
+        limit = OPTIONS['%s_jobs' % name]
+        if limit is None:
+            limit = OPTIONS['jobs']
+        limits[name] = max(1, limit)
+    return limits
+
+
+def pipeline_stage(name):
+    '''Context manager bounding concurrency of the given pipeline stage'''
+    if PIPELINE is None:
+        return contextlib.nullcontext()
+    return PIPELINE.stage(name)
 
 
 def usage():
@@ -287,10 +935,114 @@ def usage():
 
     print('''
     Usage:
-    codesign.py <engine-commit-hash>
+    codesign.py [options] <engine-commit-hash>... [--<dependency> <revision>]...
+    codesign.py --verify <request-uuid>
+
+    Any number of engine and dependency revisions may be signed in one run,
+    sharing every pool and the notary poller. dependency is one of
+    ios-deploy, libimobiledevice, libplist, usbmuxd or openssl.
+
+    Options:
+    --jobs <n>              concurrency of every pipeline stage (default 4)
+    --<stage>-jobs <n>      concurrency of a single stage, where stage is
+                            one of download, extract, sign, repackage,
+                            notarize or upload
+    --sign-min-batch <n>    fewest binaries per codesign call when a group
+                            is spread over the sign jobs (default 1)
+    --notary-initial-delay <seconds>
+    --notary-poll-interval <seconds>
+    --notary-max-poll-interval <seconds>
+    --notary-deadline <seconds>
+    --notary-checks-per-minute <n>
+                            schedule of notarization status checks; the
+                            checks per minute only count altool launches,
+                            statuses already read from the history are free
+    --no-notary-history     check each request on its own rather than reading
+                            all of them from the notarization history
+    --extract-mode <mode>   "selective" (default) extracts only the files to
+                            sign, "full" unzips entire archives
+    --sign-cache-dir <dir>  where signed binaries are cached across runs
+    --sign-cache-mb <n>     size cap of the signing cache, 0 disables it
+    --nested-zip-memory-mb <n>
+                            size past which nested zips are buffered in a
+                            temporary file rather than in memory
+    --resume <session>      pick up each archive of an earlier session from
+                            its last completed stage
+    --storage <backend>     "gcs" keeps one authenticated client for the
+                            whole run, "gsutil" runs gsutil per transfer,
+                            "local" maps gs:// onto --storage-root; "auto"
+                            (default) picks gcs if google-cloud-storage is
+                            installed
+    --storage-root <dir>    directory used by the local backend
+    --signed-index <path>   index of archives signed by earlier runs, unchanged
+                            inputs are copied from their earlier output
+                            rather than signed again, "" disables it
+    --batch-notarize        notarize all archives with a single submission,
+                            falling back to one submission per archive if
+                            the batch is rejected
+    --daemon                keep running and take signing jobs over HTTP:
+                            POST /jobs {"args": [<revision>...], "priority": n}
+                            queues a job, GET /jobs[/<id>] reports status
+    --daemon-port <port>    localhost port of the daemon (default 8765)
+    --daemon-jobs <n>       jobs the daemon runs at once (default 2)
+    --no-verify-signatures  skip checking each signed binary for a timestamped
+                            hardened runtime signature with the expected
+                            entitlements before notarizing
+    --disk-budget-mb <n>    cap on the disk taken by archives being processed,
+                            downloads wait for earlier archives to be uploaded
+                            and deleted while it would be exceeded
+    --staging-dir <dir>     where binaries are extracted for signing, such as
+                            a tmpfs mount, rather than next to their archive
+    --unlisted-binaries <mode>
+                            what to do about Mach-O binaries in a zip, nested
+                            zips included, that ARCHIVES does not list:
+                            "report" (default) logs them, "sign" signs them
+                            without entitlements, "fail" exits, "ignore"
+                            skips looking for them
     ''')
 
 
+def parse_options(args):
+    '''Strip recognized options from args into OPTIONS, return the rest'''
+    remaining = []
+    index = 0
+    while index < len(args):
+        arg = args[index]
+        index += 1
+        match = re.search('^--([a-z-]+)(=(.*))?$', arg)
+        key = match.group(1).replace('-', '_') if match else None
+        if key not in OPTIONS and key and isinstance(OPTIONS.get(key[3:]), bool):
+            # --no-<flag> turns a flag back off
+            if key.startswith('no_') and match.group(3) is None:
+                OPTIONS[key[3:]] = False
+                continue
+        if key not in OPTIONS:
+            remaining.append(arg)
+            continue
+        if isinstance(OPTIONS[key], bool):
+            if match.group(3) is not None:
+                print('Option --%s does not take a value' % match.group(1))
+                exit(1)
+            OPTIONS[key] = True
+            continue
+        value = match.group(3)
+        if value is None:
+            if index >= len(args):
+                print('Missing value for option %s' % arg)
+                exit(1)
+            value = args[index]
+            index += 1
+        if isinstance(OPTIONS[key], str):
+            OPTIONS[key] = value
+            continue
+        try:
+            OPTIONS[key] = int(value)
+        except ValueError:
+            print('Invalid value "%s" for option --%s' % (value, match.group(1)))
+            exit(1)
+    return remaining
+
+
 def validate_command(command_name):
     '''Validate the given command exists on PATH'''
 
@@ -300,13 +1052,106 @@ def validate_command(command_name):
 
 
 def create_working_dir(parent):
-    '''Clean our build folders'''
-    dirname = os.path.join(parent, '%i_session' % STARTING_TIME)
-    os.mkdir(dirname)
+    '''Clean our build folders, or reuse the session being resumed'''
+    if OPTIONS['resume']:
+        dirname = os.path.join(parent, OPTIONS['resume'])
+        if not os.path.isdir(dirname):
+            print('Cannot resume, %s does not exist' % dirname)
+            exit(1)
+    else:
+        dirname = os.path.join(parent, '%i_session' % STARTING_TIME)
+        os.mkdir(dirname)
     get_logs_dir()
     return dirname
 
 
+class Journal(object):
+    '''Durable record of how far each archive of a session has progressed.
+
+    Entries are keyed by the archive's input cloud path and hold its last
+    completed stage from JOURNAL_STAGES, along with hashes and the notary
+    RequestUUID once known. The file is rewritten atomically on every
+    update, so it survives a crash at any point.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.isfile(path):
+            self.entries = read_json_file(path)
+
+    def get(self, key):
+        '''Returns a copy of the entry for key, empty if there is none'''
+        with self.lock:
+            return dict(self.entries.get(key, {}))
+
+    def reached(self, key, stage):
+        '''Whether key has completed the given stage'''
+        current = self.get(key).get('stage')
+        if current is None:
+            return False
+        return JOURNAL_STAGES.index(current) >= JOURNAL_STAGES.index(stage)
+
+    def record(self, key, stage, **fields):
+        '''Mark key as having completed stage, along with any extra fields'''
+        with self.lock:
+            entry = self.entries.setdefault(key, {})
+            entry.update(fields)
+            entry['stage'] = stage
+            write_json_file(self.path, self.entries)
+
+    def reset(self, key):
+        '''Forget everything recorded for key'''
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def forget(self, keys):
+        '''Drop the entries of keys for good, e.g. once they are uploaded'''
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+            write_json_file(self.path, self.entries)
+
+
+class SignedIndex(object):
+    '''Persistent record of archives notarized by earlier runs.
+
+    Entries are keyed by input_fingerprint() of an unsigned archive and hold
+    the cloud path its notarized output was uploaded to, along with that
+    output's metadata so a since overwritten output is not reused. Unlike
+    the journal it outlives the session.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.isfile(path):
+            self.entries = read_json_file(path)
+
+    def get(self, fingerprint):
+        '''Returns the entry for fingerprint, None if there is none'''
+        with self.lock:
+            return self.entries.get(fingerprint)
+
+    def record(self, fingerprint, **fields):
+        '''Remember the notarized output of fingerprint'''
+        with self.lock:
+            self.entries[fingerprint] = fields
+            write_json_file(self.path, self.entries)
+
+
+def write_json_file(path, data):
+    '''Atomically replace path with data, durable once this returns'''
+    partial = path + '.partial'
+    with open(partial, 'w') as json_file:
+        json.dump(data, json_file, indent=1, sort_keys=True)
+        json_file.flush()
+        os.fsync(json_file.fileno())
+    os.replace(partial, path)
+
+
 def ensure_entitlements_file():
     '''Write entitlements file if it does not exist'''
     entitlements_path = os.path.join(CWD, 'Entitlements.plist')
@@ -319,37 +1164,276 @@ def get_unique_filename(url):
     return url.replace('/', '_')
 
 
+def split_cloud_path(cloud_path):
+    '''Returns the bucket and object name of a gs:// URI'''
+    match = re.search('^gs://([^/]+)/(.+)$', cloud_path)
+    if not match:
+        raise ValueError('Not a gs:// path: %s' % cloud_path)
+    return match.group(1), match.group(2)
+
+
+class GsutilBackend(object):
+    '''Cloud storage through one gsutil process per operation'''
+
+    def download(self, cloud_path, target):
+        '''Stream cloud_path into the file object target'''
+        result = run_command(['gsutil', 'cp', cloud_path, '-'], stdout=target)
+        return result.exit_code == 0
+
+    def upload(self, local_path, cloud_path):
+        '''Upload local_path, in parallel parts if it is large'''
+        command = [
+            'gsutil',
+            '-o',
+            'GSUtil:parallel_composite_upload_threshold=%iM' % (
+                PARALLEL_UPLOAD_THRESHOLD_MB),
+            'cp',
+            local_path,
+            cloud_path,
+            ]
+        return run_command(command).exit_code == 0
+
+    def stat(self, cloud_path):
+        '''Returns size and hashes of cloud_path, None if it does not exist'''
+        # Exits non-zero for missing objects, which is not an error here
+        result = run_command(['gsutil', 'stat', cloud_path], quiet=True)
+        if result.exit_code != 0:
+            return None
+        fields = dict(re.findall(r'^\s*([^:]+):\s*(.*?)\s*$', result.output, re.M))
+        return {
+            'size': int(fields.get('Content-Length', -1)),
+            'md5': fields.get('Hash (md5)'),
+            'crc32c': fields.get('Hash (crc32c)'),
+            }
+
+    def copy(self, source, destination):
+        '''Copy between two cloud paths without downloading'''
+        return run_command(['gsutil', 'cp', source, destination]).exit_code == 0
+
+
+class GcsBackend(object):
+    '''Cloud storage through one authenticated client for the whole run
+
+    The client's HTTP session is given a connection pool large enough for
+    every concurrent transfer, so TLS connections are reused rather than
+    each transfer paying for auth and a new handshake.
+    '''
+
+    def __init__(self, pool_size):
+        import google.auth
+        import google.auth.transport.requests
+        import requests.adapters
+        credentials, project = google.auth.default(scopes=gcs.Client.SCOPE)
+        session = google.auth.transport.requests.AuthorizedSession(credentials)
+        session.mount('https://', requests.adapters.HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size))
+        self.client = gcs.Client(
+            project=project,
+            credentials=credentials,
+            _http=session)
+
+    def blob(self, cloud_path):
+        '''Returns a handle on the object at cloud_path'''
+        bucket_name, name = split_cloud_path(cloud_path)
+        return self.client.bucket(bucket_name).blob(name)
+
+    def download(self, cloud_path, target):
+        '''Stream cloud_path into the file object target'''
+        try:
+            self.blob(cloud_path).download_to_file(target)
+        except gcs_exceptions.GoogleAPIError as error:
+            log('Download of %s failed: %s' % (cloud_path, error))
+            return False
+        return True
+
+    def upload(self, local_path, cloud_path):
+        '''Upload local_path, in parallel parts if it is large'''
+        blob = self.blob(cloud_path)
+        try:
+            if os.path.getsize(local_path) >= PARALLEL_UPLOAD_THRESHOLD_MB * 1024 * 1024:
+                from google.cloud.storage import transfer_manager
+                transfer_manager.upload_chunks_concurrently(
+                    local_path,
+                    blob,
+                    chunk_size=PARALLEL_UPLOAD_CHUNK_MB * 1024 * 1024)
+            else:
+                blob.upload_from_filename(local_path)
+        except gcs_exceptions.GoogleAPIError as error:
+            log('Upload of %s failed: %s' % (cloud_path, error))
+            return False
+        return True
+
+    def stat(self, cloud_path):
+        '''Returns size and hashes of cloud_path, None if it does not exist'''
+        bucket_name, name = split_cloud_path(cloud_path)
+        try:
+            blob = self.client.bucket(bucket_name).get_blob(name)
+        except gcs_exceptions.GoogleAPIError as error:
+            log('Stat of %s failed: %s' % (cloud_path, error))
+            return None
+        if blob is None:
+            return None
+        return {
+            'size': blob.size,
+            'md5': blob.md5_hash,
+            'crc32c': blob.crc32c,
+            }
+
+    def copy(self, source, destination):
+        '''Copy between two cloud paths without downloading'''
+        try:
+            # Large objects take several rewrite calls
+            token, _, _ = self.blob(destination).rewrite(self.blob(source))
+            while token is not None:
+                token, _, _ = self.blob(destination).rewrite(
+                    self.blob(source),
+                    token=token)
+        except gcs_exceptions.GoogleAPIError as error:
+            log('Copy of %s failed: %s' % (source, error))
+            return False
+        return True
+
+
+class LocalBackend(object):
+    '''Cloud storage simulated by a directory, gs://bucket/name being
+    root/bucket/name, for tests and benchmarks'''
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, cloud_path):
+        return os.path.join(self.root, *split_cloud_path(cloud_path))
+
+    def download(self, cloud_path, target):
+        '''Stream cloud_path into the file object target'''
+        try:
+            with open(self.path(cloud_path), 'rb') as source:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def upload(self, local_path, cloud_path):
+        '''Copy local_path into place atomically'''
+        destination = self.path(cloud_path)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        shutil.copyfile(local_path, destination + '.partial')
+        os.replace(destination + '.partial', destination)
+        return True
+
+    def stat(self, cloud_path):
+        '''Returns size and hashes of cloud_path, None if it does not exist'''
+        path = self.path(cloud_path)
+        if not os.path.isfile(path):
+            return None
+        digests = hash_file(path, ['md5'])
+        return {
+            'size': digests['size'],
+            'md5': base64.b64encode(bytes.fromhex(digests['md5'])).decode(),
+            'crc32c': None,
+            }
+
+    def copy(self, source, destination):
+        '''Copy between two cloud paths'''
+        if not os.path.isfile(self.path(source)):
+            return False
+        return self.upload(self.path(source), destination)
+
+
+def create_storage():
+    '''Returns the storage backend selected by --storage'''
+    name = OPTIONS['storage']
+    if name == 'auto':
+        name = 'gcs' if gcs is not None else 'gsutil'
+    if name == 'gcs':
+        if gcs is None:
+            log_and_exit('--storage gcs requires the google-cloud-storage package')
+        limits = stage_limits()
+        return GcsBackend(limits['download'] + limits['upload'])
+    if name == 'gsutil':
+        validate_command('gsutil')
+        return GsutilBackend()
+    if name == 'local':
+        if not OPTIONS['storage_root']:
+            log_and_exit('--storage local requires --storage-root')
+        return LocalBackend(OPTIONS['storage_root'])
+    return log_and_exit('Unknown storage backend "%s"' % name)
+
+
 def download(cloud_path, local_dest_path):
-    '''Download supplied Google Storage URI'''
+    '''Download supplied Google Storage URI, returns digests of the file'''
     if os.path.isfile(local_dest_path):
         log('Skipping download of %s, already exists locally\n' % cloud_path)
         return False
 
     log('Downloading %s...\n' % cloud_path)
 
-    command = [
-        'gsutil',
-        'cp',
-        cloud_path,
-        local_dest_path,
-        ]
-    exit_code = subprocess.call(command)
-    return exit_code == 0
+    # Stream through a writer so the file is hashed as it is written
+    partial_path = local_dest_path + '.partial'
+    with pipeline_stage('download'), METRICS.timed('download') as sample:
+        with open(partial_path, 'wb') as target:
+            writer = HashingWriter(target)
+            succeeded = STORAGE.download(cloud_path, writer)
+        sample['bytes'] = writer.size
+    if not succeeded:
+        os.remove(partial_path)
+        return False
+    os.replace(partial_path, local_dest_path)
+    digests = writer.digests()
+    record_digests(local_dest_path, digests, 'downloaded')
+    return digests
     #if exit_code != 0:
     #    log_and_exit('Download of %s failed!' % cloud_path, exit_code)
 
 
+def input_fingerprint(input_cloud_path, config):
+    '''Identify the unsigned contents of input_cloud_path and how they get signed
+
+    Returns None if the object does not exist or storage reports no hash.
+    '''
+    with METRICS.timed('stat'):
+        metadata = STORAGE.stat(input_cloud_path)
+    if metadata is None or not (metadata['md5'] or metadata['crc32c']):
+        return None
+    signing = {
+        'config': config,
+        'identity': CODESIGN_CERT_NAME,
+        'entitlements': file_sha256(os.path.join(CWD, 'Entitlements.plist')),
+        'input': metadata,
+        }
+    return hashlib.sha256(
+        json.dumps(signing, sort_keys=True).encode()).hexdigest()
+
+
+def reuse_signed_output(fingerprint, output_cloud_path):
+    '''Copy the earlier notarized output of fingerprint to output_cloud_path
+
+    Returns the cloud path copied from, or None if there is no usable output.
+    '''
+    previous = SIGNED_INDEX.get(fingerprint)
+    if previous is None:
+        return None
+    source = previous['output_cloud_path']
+    if STORAGE.stat(source) != previous['output']:
+        log('%s changed since it was indexed, not reusing it' % source)
+        return None
+    if source != output_cloud_path:
+        with METRICS.timed('copy'):
+            if not STORAGE.copy(source, output_cloud_path):
+                log('Copy of %s failed' % source)
+                return None
+    return source
+
+
 def upload(local_path, cloud_path):
-    '''Upload local_path to GCP cloud_path'''
-    command = [
-        'gsutil',
-        'cp',
-        local_path,
-        cloud_path,
-        ]
-    exit_code = subprocess.call(command)
-    if exit_code != 0:
-        log_and_exit('Upload of %s failed!' % cloud_path, exit_code)
+    '''Upload local_path to GCP cloud_path, returns whether it succeeded'''
+    with METRICS.timed('upload') as sample:
+        sample['bytes'] = os.path.getsize(local_path)
+        succeeded = STORAGE.upload(local_path, cloud_path)
+    if not succeeded:
+        log('Upload of %s failed' % cloud_path)
+    return succeeded
 
 
 def read_json_file(file_path):
@@ -361,24 +1445,128 @@ def read_json_file(file_path):
 
 
 def create_staging_name(full_file_path):
-    '''Given zip archive, create corresponding, adjacent staging dir'''
-    return full_file_path + '.staging'
+    '''Given zip archive, create corresponding staging dir, adjacent unless
+    --staging-dir is set'''
+    if STAGING_DIR is None or full_file_path.startswith(STAGING_DIR + os.sep):
+        return full_file_path + '.staging'
+    # Archives in working_dir all have unique names
+    return os.path.join(STAGING_DIR, os.path.basename(full_file_path) + '.staging')
 
 
 def unzip_archive(file_path):
     '''Calls subprocess to unzip archive'''
     archive_dirname = create_staging_name(file_path)
-    exit_code = subprocess.call([
-        'unzip',
-        file_path,
-        '-d',
-        archive_dirname])
+    with pipeline_stage('extract'):
+        exit_code = run_command([
+            'unzip',
+            file_path,
+            '-d',
+            archive_dirname]).exit_code
     if exit_code != 0:
         log('Unzipping of %s failed' % file_path)
         return None
     return archive_dirname
 
 
+def get_member_names(config):
+    '''Returns names of all zip members listed in config, nested zips included'''
+    names = []
+    for entry in config.get('files', []) + config.get('files_with_entitlements', []):
+        if isinstance(entry, dict):
+            names.append(entry['path'])
+        else:
+            names.append(entry)
+    return names
+
+
+def get_nested_configs(config):
+    '''Returns the configs of nested zips listed in config'''
+    return [
+        entry for entry in config.get('files', []) + config.get('files_with_entitlements', [])
+        if isinstance(entry, dict)]
+
+
+def get_binary_member_names(config):
+    '''Returns names of the binaries listed in config, nested zips excluded'''
+    nested_names = [nested['path'] for nested in get_nested_configs(config)]
+    return [name for name in get_member_names(config) if name not in nested_names]
+
+
+def extract_member(archive, info, destination, label):
+    '''Stream a single zip member to disk, restoring its mode and mtime'''
+    path = os.path.join(destination, info.filename)
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with archive.open(info) as source, open(path, 'wb') as target:
+        writer = HashingWriter(target)
+        shutil.copyfileobj(source, writer, 1024 * 1024)
+    record_digests('%s/%s' % (label, info.filename), writer.digests(), 'extracted')
+    mode = (info.external_attr >> 16) & 0o7777
+    if mode:
+        os.chmod(path, mode)
+    mtime = time.mktime(info.date_time + (0, 0, -1))
+    os.utime(path, (mtime, mtime))
+
+
+def extract_members(source, names, archive_dirname, label):
+    '''Extracts only the given members of a zip archive, in process
+
+    source is the path to, or a file object of, the archive. Returns None if
+    any member is missing or is a symlink, in which case the caller should
+    fall back to full extraction with unzip_archive().
+    '''
+    with pipeline_stage('extract'):
+        with zipfile.ZipFile(source) as archive:
+            infos = []
+            for name in names:
+                try:
+                    info = archive.getinfo(name)
+                except KeyError:
+                    log('%s not found in %s' % (name, label))
+                    return None
+                if stat.S_ISLNK(info.external_attr >> 16):
+                    log('%s is a symlink in %s' % (name, label))
+                    return None
+                infos.append(info)
+            if not os.path.isdir(archive_dirname):
+                os.makedirs(archive_dirname)
+            for info in infos:
+                extract_member(archive, info, archive_dirname, label)
+    return archive_dirname
+
+
+class ZipBuffer(tempfile.SpooledTemporaryFile):
+    '''SpooledTemporaryFile that zipfile can open members of
+
+    zipfile asks its file whether it is seekable, which SpooledTemporaryFile
+    only answers from Python 3.11 on.
+    '''
+
+    def seekable(self):
+        return True
+
+
+def create_zip_buffer():
+    '''Returns an empty buffer for a nested zip, in memory up to a threshold'''
+    return ZipBuffer(max_size=OPTIONS['nested_zip_memory_mb'] * 1024 * 1024)
+
+
+def read_nested_zip(archive, name, label):
+    '''Copy a nested zip member of an open archive into a zip buffer'''
+    try:
+        info = archive.getinfo(name)
+    except KeyError:
+        log_and_exit('Cannot find file %s in %s from config' % (name, label))
+    buffer = create_zip_buffer()
+    writer = HashingWriter(buffer)
+    with archive.open(info) as source:
+        shutil.copyfileobj(source, writer, 1024 * 1024)
+    record_digests('%s/%s' % (label, name), writer.digests(), 'extracted')
+    buffer.seek(0)
+    return buffer
+
+
 def get_binary_names(config):
     '''Returns names of binary files to sign/notarize from dict'''
     return config['binary_paths']
@@ -389,59 +1577,604 @@ def validate_binary_exists(path):
     return os.path.isfile(path)
 
 
-def sign(path, with_entitlements=False):
-    '''Sign a single binary'''
-    log('Signing %s...' % path)
+def codesign_command(paths, with_entitlements=False):
+    '''Returns the codesign command line for signing the given binaries'''
     command = [
         'codesign',
         '-f',  # force
         '-s',  # use the cert provided by next argument
         CODESIGN_CERT_NAME,
-        path,
         '--timestamp',  # add a secure timestamp
         '--options=runtime',  # hardened runtime
         ]
     if with_entitlements:
         command += ['--entitlements', './Entitlements.plist']
-    exit_code = subprocess.call(command)
+    return command + paths
+
+
+def sign(path, with_entitlements=False):
+    '''Sign a single binary'''
+    log('Signing %s...' % path)
+    with pipeline_stage('sign'), METRICS.timed('sign'):
+        exit_code = run_command(
+            codesign_command([path], with_entitlements)).exit_code
     if exit_code != 0:
         log_and_exit('Error while attempting to sign %s' % path, exit_code)
 
 
-def run_and_return_output(command):
-    '''Takes in list/string of command, returns list of stdout'''
-    proc = subprocess.Popen(
-        command,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
-    return proc.stdout.readlines() + proc.stderr.readlines()
+def sign_batch(paths, with_entitlements=False):
+    '''Sign several binaries sharing entitlements with one codesign call
+
+    If the batch fails, each binary is signed on its own so that the error
+    points at a specific path.
+    '''
+    if len(paths) == 1:
+        sign(paths[0], with_entitlements)
+        return
+    log('Signing %s...' % ', '.join(paths))
+    with pipeline_stage('sign'), METRICS.timed('sign'):
+        exit_code = run_command(
+            codesign_command(paths, with_entitlements)).exit_code
+    if exit_code != 0:
+        log('Signing batch failed with %i, retrying one file at a time' % exit_code)
+        for path in paths:
+            sign(path, with_entitlements)
+
+
+def read_at(source, offset, size):
+    '''Read exactly size bytes at offset of file object source'''
+    source.seek(offset)
+    data = source.read(size)
+    if len(data) != size:
+        raise ValueError('truncated at offset %i' % offset)
+    return data
+
+
+def macho_slices(source):
+    '''Returns the offset of every Mach-O slice in a thin or fat binary'''
+    magic, = struct.unpack('>I', read_at(source, 0, 4))
+    if magic not in [FAT_MAGIC, FAT_MAGIC_64]:
+        return [0]
+    count, = struct.unpack('>I', read_at(source, 4, 4))
+    entry = FAT_ARCH_64 if magic == FAT_MAGIC_64 else FAT_ARCH
+    return [
+        entry.unpack(read_at(source, 8 + index * entry.size, entry.size))[2]
+        for index in range(count)]
+
+
+def inspect_code_signature(blob):
+    '''Returns the fields of interest of an embedded signature superblob'''
+    magic, _, count = struct.unpack_from('>III', blob)
+    if magic != CSMAGIC_EMBEDDED_SIGNATURE:
+        raise ValueError('bad signature magic 0x%x' % magic)
+    fields = {'signed': True}
+    for index in range(count):
+        slot, offset = struct.unpack_from('>II', blob, 12 + index * 8)
+        blob_magic, length = struct.unpack_from('>II', blob, offset)
+        payload = blob[offset + 8:offset + length]
+        if slot == CSSLOT_CODEDIRECTORY and blob_magic == CSMAGIC_CODEDIRECTORY:
+            _, flags = struct.unpack_from('>II', payload)
+            fields['adhoc'] = bool(flags & CS_ADHOC)
+            fields['runtime'] = bool(flags & CS_RUNTIME)
+        elif slot == CSSLOT_ENTITLEMENTS and blob_magic == CSMAGIC_EMBEDDED_ENTITLEMENTS:
+            fields['entitlements'] = payload
+        elif slot == CSSLOT_SIGNATURESLOT and blob_magic == CSMAGIC_BLOBWRAPPER:
+            fields['cms'] = len(payload) > 0
+            fields['timestamped'] = TIMESTAMP_TOKEN_OID in payload
+    return fields
+
+
+def inspect_slice(source, offset):
+    '''Returns the code signature fields of the Mach-O slice at offset'''
+    magic, = struct.unpack('<I', read_at(source, offset, 4))
+    if magic not in MACHO_MAGICS:
+        raise ValueError('not a Mach-O binary')
+    order, header_size = MACHO_MAGICS[magic]
+    cputype, _, _, ncmds, _ = struct.unpack(
+        order + 'iiIII',
+        read_at(source, offset + 4, 20))
+    fields = {
+        'arch': CPU_TYPES.get(cputype, 'cputype %i' % cputype),
+        'signed': False,
+        'adhoc': False,
+        'runtime': False,
+        'cms': False,
+        'timestamped': False,
+        'entitlements': None,
+        }
+    position = offset + header_size
+    for _ in range(ncmds):
+        cmd, cmdsize = struct.unpack(order + 'II', read_at(source, position, 8))
+        if cmd == LC_CODE_SIGNATURE:
+            dataoff, datasize = struct.unpack(
+                order + 'II',
+                read_at(source, position + 8, 8))
+            fields.update(inspect_code_signature(
+                read_at(source, offset + dataoff, datasize)))
+            break
+        if cmdsize < 8:
+            raise ValueError('bad load command size %i' % cmdsize)
+        position += cmdsize
+    return fields
+
+
+def signature_problems(source, entitlements):
+    '''Returns what is wrong with the code signature of the binary in file
+    object source, an empty list if nothing
+
+    entitlements is the dict the signature must carry, None if it must not
+    carry any.
+    '''
+    try:
+        slices = [inspect_slice(source, offset) for offset in macho_slices(source)]
+    except (ValueError, struct.error) as error:
+        return ['cannot be parsed, %s' % error]
+    problems = []
+    for fields in slices:
+        arch = fields['arch']
+        if not fields['signed']:
+            problems.append('%s slice is not signed' % arch)
+            continue
+        if fields['adhoc'] or not fields['cms']:
+            problems.append('%s slice is only signed ad hoc' % arch)
+        if not fields['runtime']:
+            problems.append('%s slice lacks the hardened runtime' % arch)
+        if not fields['timestamped']:
+            problems.append('%s slice lacks a secure timestamp' % arch)
+        if fields['entitlements'] is None:
+            if entitlements is not None:
+                problems.append('%s slice lacks entitlements' % arch)
+            continue
+        try:
+            embedded = plistlib.loads(fields['entitlements'])
+        except (plistlib.InvalidFileException, xml.parsers.expat.ExpatError):
+            embedded = None
+        if entitlements is None:
+            problems.append('%s slice carries unexpected entitlements' % arch)
+        elif embedded != entitlements:
+            problems.append('%s slice carries different entitlements' % arch)
+    return problems
+
+
+@timed_function('verify_signatures')
+def verify_staged_signatures(staging_dirname, config, label):
+    '''Exit unless every binary of config is properly signed, so problems
+    are caught before the round trip to the notary service'''
+    if not OPTIONS['verify_signatures']:
+        return
+    with open(os.path.join(CWD, 'Entitlements.plist'), 'rb') as plist:
+        expected = plistlib.load(plist)
+    problems = []
+    for key, entitlements in [('files', None), ('files_with_entitlements', expected)]:
+        for entry in config.get(key, []):
+            if isinstance(entry, dict):
+                continue
+            with open(os.path.join(staging_dirname, entry), 'rb') as binary:
+                problems += [
+                    '%s: %s' % (entry, problem)
+                    for problem in signature_problems(binary, entitlements)]
+    if problems:
+        log_and_exit('Invalid signatures in %s:\n%s' % (label, '\n'.join(problems)))
+    log('Verified signatures of binaries in %s' % label)
+
+
+def is_macho(header):
+    '''Whether the first 8 bytes of a file are those of a Mach-O binary'''
+    if len(header) < 8:
+        return False
+    magic, count = struct.unpack('>II', header)
+    if magic in [FAT_MAGIC, FAT_MAGIC_64]:
+        return 0 < count <= FAT_MAX_ARCHS
+    return struct.unpack('<I', header[:4])[0] in MACHO_MAGICS
+
+
+def find_unlisted_binaries(source, config, label):
+    '''Look for Mach-O binaries in a zip that config does not list
+
+    source is the path to, or a file object of, the zip. Only the first bytes
+    of each member are decompressed, nested zips are copied into zip buffers
+    and searched the same way. Returns the labels of the unlisted binaries,
+    and a copy of config extended to sign them.
+    '''
+    listed = get_member_names(config)
+    nested = dict((entry['path'], entry) for entry in get_nested_configs(config))
+    unlisted = []
+    added = []
+    extended_nested = {}
+    with zipfile.ZipFile(source) as archive:
+        for info in archive.infolist():
+            name = info.filename
+            if info.is_dir() or stat.S_ISLNK(info.external_attr >> 16):
+                continue
+            if name in listed and name not in nested:
+                continue
+            with archive.open(info) as member:
+                header = member.read(8)
+            if name not in nested and header[:4] not in ZIP_MAGICS:
+                if is_macho(header):
+                    unlisted.append('%s/%s' % (label, name))
+                    added.append(name)
+                continue
+            buffer = create_zip_buffer()
+            with archive.open(info) as member:
+                shutil.copyfileobj(member, buffer, 1024 * 1024)
+            nested_config = nested.get(name, {'path': name})
+            try:
+                found, extended = find_unlisted_binaries(
+                    buffer,
+                    nested_config,
+                    '%s/%s' % (label, name))
+            except zipfile.BadZipFile:
+                log('%s/%s looks like a zip but cannot be read' % (label, name))
+                continue
+            finally:
+                buffer.close()
+            if not found:
+                continue
+            unlisted += found
+            if name in nested:
+                extended_nested[name] = extended
+            else:
+                added.append(extended)
+    if not unlisted:
+        return unlisted, config
+    extended = dict(config)
+    for key in ['files', 'files_with_entitlements']:
+        if key in config:
+            extended[key] = [
+                extended_nested.get(entry['path'], entry) if isinstance(entry, dict) else entry
+                for entry in config[key]]
+    extended['files'] = extended.get('files', []) + added
+    return unlisted, extended
+
+
+@timed_function('scan_binaries')
+def scan_for_unlisted_binaries(zip_path, config):
+    '''Catch binaries missing from ARCHIVES before the notary rejects them,
+    returns the config to sign the downloaded zip with'''
+    mode = OPTIONS['unlisted_binaries']
+    if mode == 'ignore':
+        return config
+    unlisted, extended = find_unlisted_binaries(zip_path, config, config['path'])
+    for label in unlisted:
+        log('%s is a Mach-O binary missing from ARCHIVES' % label)
+    if not unlisted or mode == 'report':
+        return config
+    if mode == 'fail':
+        log_and_exit('%i binaries of %s are missing from ARCHIVES' % (
+            len(unlisted),
+            config['path']))
+    log('Signing %i unlisted binaries of %s without entitlements' % (
+        len(unlisted),
+        config['path']))
+    return extended
+
+
+def file_sha256(path):
+    '''Returns the hex SHA-256 digest of a file'''
+    return hash_file(path, ['sha256'])['sha256']
+
+
+class SigningCache(object):
+    '''On-disk cache of signed binaries, shared across engine revisions.
+
+    Entries are keyed by the SHA-256 of the unsigned binary, the cert name
+    and the entitlements file, and hold the signed bytes alongside a JSON
+    record of their digest, which is checked on every read. Least recently
+    used entries are evicted once the cache grows past max_bytes.
+    '''
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, path, with_entitlements):
+        '''Returns the cache key for signing the binary at path'''
+        digest = hashlib.sha256()
+        digest.update(file_sha256(path).encode())
+        digest.update(CODESIGN_CERT_NAME.encode())
+        if with_entitlements:
+            digest.update(file_sha256(os.path.join(CWD, 'Entitlements.plist')).encode())
+        return digest.hexdigest()
+
+    def fetch(self, key, path):
+        '''Overwrite path with the cached signed binary, returns False on miss'''
+        entry = os.path.join(self.directory, key)
+        try:
+            record = read_json_file(entry + '.json')
+            if file_sha256(entry) != record['sha256']:
+                log('Signing cache entry %s is corrupt, discarding it' % key)
+                self.discard(key)
+                raise IOError(key)
+            shutil.copyfile(entry, path)
+            # mtime tracks recency of use for eviction
+            os.utime(entry, None)
+        except (IOError, OSError, ValueError, KeyError):
+            with self.lock:
+                self.misses += 1
+            return False
+        with self.lock:
+            self.hits += 1
+        return True
+
+    def store(self, key, path):
+        '''Add the signed binary at path to the cache'''
+        entry = os.path.join(self.directory, key)
+        partial = '%s.%i.partial' % (entry, threading.get_ident())
+        shutil.copyfile(path, partial)
+        with open(entry + '.json', 'w') as record:
+            json.dump({'sha256': file_sha256(partial)}, record)
+        os.replace(partial, entry)
+        self.evict()
+
+    def discard(self, key):
+        '''Remove an entry and its record'''
+        entry = os.path.join(self.directory, key)
+        for name in (entry, entry + '.json'):
+            if os.path.isfile(name):
+                os.remove(name)
+
+    def evict(self):
+        '''Remove least recently used entries until under the size cap'''
+        with self.lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.directory):
+                entry = os.path.join(self.directory, name)
+                if '.' in name or not os.path.isfile(entry):
+                    continue
+                size = os.path.getsize(entry)
+                entries.append((os.path.getmtime(entry), size, name))
+                total += size
+            entries.sort()
+            while total > self.max_bytes and entries:
+                _, size, name = entries.pop(0)
+                self.discard(name)
+                total -= size
+                self.evictions += 1
+
+    def summary(self):
+        '''Returns hit/miss counters as a log line'''
+        return 'Signing cache: %i hits, %i misses, %i evictions' % (
+            self.hits,
+            self.misses,
+            self.evictions)
+
+
+def sign_with_cache(paths, with_entitlements=False):
+    '''Sign binaries in one batch, reusing cached signed copies of identical input'''
+    if SIGN_CACHE is None:
+        sign_batch(paths, with_entitlements)
+        return
+    misses = []
+    for path in paths:
+        key = SIGN_CACHE.key(path, with_entitlements)
+        if SIGN_CACHE.fetch(key, path):
+            log('Using cached signed copy of %s' % path)
+        else:
+            misses.append((path, key))
+    if not misses:
+        return
+    sign_batch([path for path, _ in misses], with_entitlements)
+    for path, key in misses:
+        SIGN_CACHE.store(key, path)
+
+
+def chunk_evenly(items, count):
+    '''Split items into at most count lists of near equal length'''
+    count = max(1, min(count, len(items)))
+    size = -(-len(items) // count)
+    return [items[index:index + size] for index in range(0, len(items), size)]
+
+
+def sign_in_parallel(paths, with_entitlements=False):
+    '''Schedule signing of paths on SIGN_EXECUTOR, returns list of futures
+
+    The paths are spread over up to --sign-jobs codesign calls of at least
+    --sign-min-batch paths each. Tasks never wait on one another, so nested
+    zips can recurse from an archive worker and still share the pool without
+    deadlocking.
+    '''
+    if SIGN_EXECUTOR is None:
+        sign_with_cache(paths, with_entitlements)
+        return []
+    calls = min(
+        stage_limits()['sign'],
+        len(paths) // max(1, OPTIONS['sign_min_batch']))
+    return [
+        SIGN_EXECUTOR.submit(with_log_context(sign_with_cache), chunk, with_entitlements)
+        for chunk in chunk_evenly(paths, calls)]
+
+
+CommandResult = collections.namedtuple(
+    'CommandResult',
+    ['exit_code', 'output', 'timed_out'])
+
+
+class BoundedCapture(object):
+    '''Keeps the start and end of what is written, dropping the middle past
+    limit bytes. Safe to write to from several threads'''
+
+    def __init__(self, limit):
+        self.half = limit // 2
+        self.lock = threading.Lock()
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.dropped = 0
+
+    def write(self, data):
+        with self.lock:
+            room = self.half - len(self.head)
+            if room > 0:
+                self.head += data[:room]
+                data = data[room:]
+            self.tail += data
+            if len(self.tail) > self.half:
+                self.dropped += len(self.tail) - self.half
+                del self.tail[:len(self.tail) - self.half]
+
+    def getvalue(self):
+        with self.lock:
+            value = bytes(self.head)
+            if self.dropped:
+                value += b'\n[... %i bytes dropped ...]\n' % self.dropped
+            return (value + bytes(self.tail)).decode('utf-8', 'replace')
+
+
+def drain(pipe, target):
+    '''Copy pipe into target until the process closes it'''
+    with pipe:
+        for chunk in iter(lambda: pipe.read1(1024 * 1024), b''):
+            target.write(chunk)
+
+
+def run_command(command, cwd=None, stdout=None, quiet=False):
+    '''Run command to completion, safe to call from any thread
+
+    stdout and stderr are drained concurrently, so a chatty tool cannot
+    block on a full pipe. Their output is captured up to
+    COMMAND_OUTPUT_LIMIT, unless stdout is given a file object to stream
+    into. The command is killed, along with anything it started, after the
+    timeout of its tool in COMMAND_TIMEOUTS. Failures are logged with their
+    output unless quiet.
+    '''
+    tool = os.path.basename(command[0])
+    if tool == 'xcrun':
+        tool = command[1]
+    timeout = COMMAND_TIMEOUTS.get(tool, COMMAND_DEFAULT_TIMEOUT)
+    capture = BoundedCapture(COMMAND_OUTPUT_LIMIT)
+    # Tools run in their own session, out of reach of Ctrl-C, so they are
+    # tracked for kill_commands() to stop, and none start once it has run
+    with COMMANDS_LOCK:
+        if STOP.is_set():
+            log('Not running %s, as the run is stopping' % tool)
+            return CommandResult(-signal.SIGKILL, '', False)
+        proc = subprocess.Popen(
+            command,
+            cwd=cwd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True)
+        COMMANDS.add(proc)
+    drainers = [
+        threading.Thread(target=drain, args=(proc.stdout, stdout or capture)),
+        threading.Thread(target=drain, args=(proc.stderr, capture)),
+        ]
+    for drainer in drainers:
+        drainer.start()
+    timed_out = False
+    try:
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+    finally:
+        with COMMANDS_LOCK:
+            COMMANDS.discard(proc)
+    for drainer in drainers:
+        drainer.join()
+
+    result = CommandResult(proc.returncode, capture.getvalue(), timed_out)
+    if timed_out:
+        log('%s did not finish within %i seconds and was killed' % (tool, timeout))
+    elif result.exit_code != 0 and not quiet:
+        log('%s exited with %i:\n%s' % (tool, result.exit_code, result.output))
+    return result
+
+
+def kill_commands():
+    '''Kill every running command, along with anything it started'''
+    with COMMANDS_LOCK:
+        for proc in COMMANDS:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                # Already exited
+                pass
 
 
 def get_logs_dir():
     '''Ensure exists, and return path to global logs dir'''
-    log_dir = os.path.join(CWD, '%i_%s_logs' % (STARTING_TIME, sys.argv[1]))
+    log_dir = os.path.join(
+        CWD,
+        '%i_%s_logs' % (STARTING_TIME, ARGS[0] if ARGS else 'daemon'))
     if not os.path.isdir(log_dir):
         os.mkdir(log_dir)
     return log_dir
 
 
-def zip_stats(path):
-    '''Append hash and size stats to log'''
-    log('Getting stats for %s...\n' % path)
+def zip_index(source):
+    '''Returns dict of member name to size, CRC and mode of a zip
+
+    Only the central directory is read, nothing is extracted.
+    '''
+    index = {}
+    with open_binary(source) as source_file:
+        with zipfile.ZipFile(source_file) as archive:
+            for info in archive.infolist():
+                index[info.filename] = {
+                    'size': info.file_size,
+                    'crc': info.CRC,
+                    'mode': info.external_attr >> 16,
+                    }
+    return index
+
+
+def zip_stats(source, label):
+    '''Save the index of a zip to the logs dir and return it'''
+    index = zip_index(source)
     logfilename = os.path.join(
         get_logs_dir(),
         'zip_contents',
-        '%f_%s.log' % (
+        '%f_%s.json' % (
             time.time(),
-            os.path.basename(path)),
+            os.path.basename(label)),
         )
-    log(run_and_return_output(['unzip', '-l', path]), logfilename)
+    log(json.dumps(index, separators=(',', ':'), sort_keys=True), logfilename)
+    return index
+
+
+def diff_zip_indexes(before, after):
+    '''Returns (added, removed, changed) member names between two indexes'''
+    added = sorted(set(after) - set(before))
+    removed = sorted(set(before) - set(after))
+    changed = sorted(
+        name for name in set(before) & set(after)
+        if before[name] != after[name])
+    return added, removed, changed
+
+
+def verify_zip_changes(before, after, expected, label):
+    '''Exit unless the only members that changed are the expected ones
+
+    Directory entries the zip tool may add when falling back to update_zip()
+    are ignored.
+    '''
+    added, removed, changed = diff_zip_indexes(before, after)
+    added = [name for name in added if not name.endswith('/')]
+    unexpected = [name for name in changed if name not in expected]
+    if added or removed or unexpected:
+        log_and_exit('Unexpected changes to %s, added: %s, removed: %s, changed: %s' % (
+            label,
+            ', '.join(added),
+            ', '.join(removed),
+            ', '.join(unexpected)))
+    log('%i members of %s changed as expected' % (len(changed), label))
 
 
 def update_zip(path, destination_path):
     '''Zips up a directory to the destination path'''
-    with Cd(path):
-        subprocess.call([
+    # Pass cwd rather than chdir, as other archives are processed concurrently
+    with pipeline_stage('repackage'):
+        run_command([
             'zip',
             '--symlinks',
             '-r',
@@ -450,11 +2183,261 @@ def update_zip(path, destination_path):
             '.',
             '-i',
             '*',
-            ])
+            ], cwd=path)
+
+
+def dos_date_time(date_time):
+    '''Returns (time, date) fields for a zip header from a date_time tuple'''
+    year, month, day, hours, minutes, seconds = date_time
+    return (
+        hours << 11 | minutes << 5 | seconds // 2,
+        (year - 1980) << 9 | month << 5 | day)
+
+
+def encoded_filename(info):
+    '''Returns the member name exactly as it was stored in the archive'''
+    if info.flag_bits & ZIP_FLAG_UTF8:
+        return info.orig_filename.encode('utf-8')
+    return info.orig_filename.encode('cp437')
+
+
+def copy_bytes(source, target, length):
+    '''Copy length bytes between file objects in large chunks'''
+    while length > 0:
+        chunk = source.read(min(length, 1024 * 1024))
+        if not chunk:
+            raise IOError('Unexpected end of file')
+        target.write(chunk)
+        length -= len(chunk)
+
+
+def copy_raw_member(source, info, target):
+    '''Copy a member's local header and compressed data verbatim'''
+    source.seek(info.header_offset)
+    header = source.read(ZIP_LOCAL_HEADER.size)
+    fields = ZIP_LOCAL_HEADER.unpack(header)
+    if fields[0] != ZIP_LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipFile('Bad local header for %s' % info.filename)
+    length = fields[-2] + fields[-1] + info.compress_size
+    if info.flag_bits & ZIP_FLAG_DATA_DESCRIPTOR:
+        source.seek(info.header_offset + ZIP_LOCAL_HEADER.size + length)
+        if source.read(4) == ZIP_DATA_DESCRIPTOR_SIGNATURE:
+            length += 16
+        else:
+            length += 12
+    source.seek(info.header_offset)
+    copy_bytes(source, target, ZIP_LOCAL_HEADER.size + length)
+
+
+def get_size(path_or_file):
+    '''Returns the size of a file given its path or a seekable file object'''
+    if isinstance(path_or_file, str):
+        return os.path.getsize(path_or_file)
+    path_or_file.seek(0, os.SEEK_END)
+    return path_or_file.tell()
+
+
+@contextlib.contextmanager
+def open_binary(path_or_file, mode='rb'):
+    '''Opens a path, or rewinds and passes through an open file object'''
+    if isinstance(path_or_file, str):
+        with open(path_or_file, mode) as opened:
+            yield opened
+    else:
+        path_or_file.seek(0)
+        yield path_or_file
+
+
+def write_deflated_member(info, path, target):
+    '''Deflate the file at path as a replacement for info
+
+    path may also be an open file object.
+    Everything but the contents, i.e. name, timestamp, external attributes
+    and extra fields, is kept from the original member. Returns
+    (flag_bits, crc, compress_size, file_size) for the central directory.
+    '''
+    crc = 0
+    file_size = 0
+    compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    # Sizes go before the data, so spool the compressed stream first
+    with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as spool:
+        with open_binary(path) as source:
+            while True:
+                chunk = source.read(1024 * 1024)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                file_size += len(chunk)
+                spool.write(compressor.compress(chunk))
+        spool.write(compressor.flush())
+        compress_size = spool.tell()
+        if file_size > ZIP_MAX_SIZE or compress_size > ZIP_MAX_SIZE:
+            raise OverflowError('%s needs zip64' % path)
+        flag_bits = info.flag_bits & ZIP_FLAG_UTF8
+        dos_time, dos_date = dos_date_time(info.date_time)
+        name = encoded_filename(info)
+        target.write(ZIP_LOCAL_HEADER.pack(
+            ZIP_LOCAL_HEADER_SIGNATURE,
+            max(info.extract_version, 20),
+            0,
+            flag_bits,
+            zipfile.ZIP_DEFLATED,
+            dos_time,
+            dos_date,
+            crc,
+            compress_size,
+            file_size,
+            len(name),
+            0))
+        target.write(name)
+        spool.seek(0)
+        copy_bytes(spool, target, compress_size)
+    return flag_bits, crc, compress_size, file_size
+
+
+def rewrite_zip(source_path, replacements, destination_path, digests=None):
+    '''Write a copy of a zip with some members replaced by local files
+
+    replacements maps member names to the paths of their new contents. The
+    source, destination and each replacement may also be an open file
+    object, e.g. the buffer of a nested zip. Untouched members are copied as
+    raw compressed bytes, so they keep their CRC, compression and attributes
+    (symlinks included), and only the replacements are deflated again.
+    Returns False without writing anything if the archive would need zip64
+    records or a replacement is not a regular member, e.g. a path signed
+    through a symlink, so the caller can fall back to update_zip(). If
+    digests is a dict, it is filled in with the size and digests of the
+    written archive.
+    '''
+    with open_binary(source_path) as source:
+        with zipfile.ZipFile(source) as archive:
+            infos = archive.infolist()
+            comment = archive.comment
+    if len(infos) >= ZIP_MAX_ENTRIES:
+        return False
+    infos_by_name = dict((info.filename, info) for info in infos)
+    for name, path in replacements.items():
+        info = infos_by_name.get(name)
+        if info is None or stat.S_ISLNK(info.external_attr >> 16):
+            return False
+        if get_size(path) >= ZIP_MAX_SIZE:
+            return False
+    for info in infos:
+        if max(info.file_size, info.compress_size, info.header_offset) >= ZIP_MAX_SIZE:
+            return False
+
+    central_directory = []
+    with open_binary(source_path) as source, open_binary(destination_path, 'wb') as output:
+        target = HashingWriter(output)
+        for info in infos:
+            offset = target.tell()
+            if info.filename in replacements:
+                flag_bits, crc, compress_size, file_size = write_deflated_member(
+                    info,
+                    replacements[info.filename],
+                    target)
+                compress_type = zipfile.ZIP_DEFLATED
+                extract_version = max(info.extract_version, 20)
+            else:
+                copy_raw_member(source, info, target)
+                flag_bits = info.flag_bits
+                crc = info.CRC
+                compress_size = info.compress_size
+                file_size = info.file_size
+                compress_type = info.compress_type
+                extract_version = info.extract_version
+            if offset > ZIP_MAX_SIZE:
+                raise OverflowError('%s needs zip64' % destination_path)
+            dos_time, dos_date = dos_date_time(info.date_time)
+            name = encoded_filename(info)
+            central_directory.append(ZIP_CENTRAL_HEADER.pack(
+                ZIP_CENTRAL_HEADER_SIGNATURE,
+                info.create_version,
+                info.create_system,
+                extract_version,
+                info.reserved,
+                flag_bits,
+                compress_type,
+                dos_time,
+                dos_date,
+                crc,
+                compress_size,
+                file_size,
+                len(name),
+                len(info.extra),
+                len(info.comment),
+                0,
+                info.internal_attr,
+                info.external_attr,
+                offset) + name + info.extra + info.comment)
+        directory_offset = target.tell()
+        for record in central_directory:
+            target.write(record)
+        directory_size = target.tell() - directory_offset
+        if directory_offset + directory_size > ZIP_MAX_SIZE:
+            raise OverflowError('%s needs zip64' % destination_path)
+        target.write(ZIP_END_RECORD.pack(
+            ZIP_END_RECORD_SIGNATURE,
+            0,
+            0,
+            len(infos),
+            len(infos),
+            directory_size,
+            directory_offset,
+            len(comment)) + comment)
+    if digests is not None:
+        digests.update(target.digests())
+    return True
+
+
+def repackage_zip(staging_dirname, zip_path, replacements):
+    '''Write signed members back into zip_path, returns its new digests
+
+    replacements maps member names to paths in staging_dirname, or to the
+    buffers of rebuilt nested zips.
+    '''
+    rewritten_path = zip_path + '.rewrite'
+    digests = {}
+    try:
+        with pipeline_stage('repackage'):
+            rewritten = rewrite_zip(
+                zip_path,
+                replacements,
+                rewritten_path,
+                digests)
+    except OverflowError as error:
+        log('%s, falling back to zip' % error)
+        rewritten = False
+    if rewritten:
+        os.replace(rewritten_path, zip_path)
+        record_digests(zip_path, digests, 'repackaged')
+        return digests
+    if os.path.isfile(rewritten_path):
+        os.remove(rewritten_path)
+    log('Updating %s with zip instead...' % zip_path)
+    for name, replacement in replacements.items():
+        if not isinstance(replacement, str):
+            with open(os.path.join(staging_dirname, name), 'wb') as target:
+                replacement.seek(0)
+                shutil.copyfileobj(replacement, target, 1024 * 1024)
+    update_zip(staging_dirname, zip_path)
+    digests = hash_file(zip_path)
+    record_digests(zip_path, digests, 'repackaged')
+    return digests
 
 
 def upload_zip_to_notary(archive_path):
     '''Uploads zip file to the notary service'''
+    request_uuid = try_upload_zip_to_notary(archive_path)
+    if request_uuid is None:
+        log_and_exit(
+                'Failed to upload file %s to the notary service' % archive_path)
+    return request_uuid
+
+
+def try_upload_zip_to_notary(archive_path):
+    '''Uploads zip file to the notary service, returns None if that failed'''
     # Sometimes this flakes, so try twice
     attempts_left = 5
     while attempts_left > 0:
@@ -473,7 +2456,9 @@ def upload_zip_to_notary(archive_path):
             archive_path,
             ]
         # Note that this tool outputs to STDOUT on Xcode 11, STDERR on earlier
-        out = '\n'.join(run_and_return_output(command))
+        with METRICS.timed('notary_submit') as sample:
+            sample['bytes'] = os.path.getsize(archive_path)
+            out = run_command(command, quiet=True).output
         log('out: %s' % out)
 
         match = re.search('RequestUUID = ([a-z0-9-]+)', out)
@@ -489,12 +2474,25 @@ def upload_zip_to_notary(archive_path):
 
         return request_uuid
 
-    log_and_exit(
-            'Failed to upload file %s to the notary service' % archive_path)
+    return None
 
 
 def check_status(uuid):
     '''Check the status of our request'''
+    status = notary_status(uuid)
+    if status is None:
+        log_and_exit('Unrecognized status output for request %s' % uuid)
+    if status == 'success':
+        return True
+    if status == 'in progress':
+        log('Notarization is still pending...\n')
+        return False
+
+    return log_and_exit('Notarization failed with: %s' % status)
+
+
+def query_status(uuid):
+    '''Returns the status string of a request, or None if it was unreadable'''
     command = [
         'xcrun',
         'altool',
@@ -508,21 +2506,97 @@ def check_status(uuid):
 
     log('Checking on the status of request: %s' % uuid)
     # Note that this tool outputs to STDOUT on Xcode 11, STDERR on earlier
-    output = '\n'.join(run_and_return_output(command))
+    throttle_notary_check()
+    with METRICS.timed('notary_status'):
+        output = run_command(command, quiet=True).output
     log(output)
 
     match = re.search('[ ]*Status: ([a-z ]+)', output)
     if not match:
-        log_and_exit('Unrecognized output from: %s' % ' '.join(command))
+        log('Unrecognized output from: %s' % ' '.join(command))
+        return None
 
-    status = match.group(1)
-    if status == 'success':
-        return True
-    if status == 'in progress':
-        log('Notarization is still pending...\n')
-        return False
+    return match.group(1)
 
-    return log_and_exit('Notarization failed with: %s' % status)
+
+def notary_status(uuid):
+    '''Returns the status string of a request, from the notarization history
+    if it lists the request, or else None if it was unreadable'''
+    if NOTARY_HISTORY is not None:
+        status = NOTARY_HISTORY.status(uuid)
+        if status is not None:
+            log('Request %s is %s according to the notarization history' % (uuid, status))
+            return status
+    return query_status(uuid)
+
+
+def fetch_notarization_history(page=0):
+    '''Returns dict of request UUID to status of the notary submissions on a
+    page of the history, most recent first, and the number of the next page.
+    Both are empty if the history could not be read'''
+    command = [
+        'xcrun',
+        'altool',
+        '--notarization-history',
+        str(page),
+        '-u',
+        CODESIGN_USERNAME,
+        '--password',
+        APP_SPECIFIC_PASSWORD,
+        '--output-format',
+        'xml',
+        ]
+    log('Fetching page %i of the notarization history' % page)
+    # Only stdout holds the plist, and it is not truncated like captured output
+    output = io.BytesIO()
+    throttle_notary_check()
+    with METRICS.timed('notary_history'):
+        exit_code = run_command(command, stdout=output, quiet=True).exit_code
+    if exit_code != 0:
+        log('Fetching the notarization history failed with %i' % exit_code)
+        return {}, None
+    try:
+        history = plistlib.loads(output.getvalue())['notarization-history']
+        statuses = dict(
+            (item['RequestUUID'].lower(), item['Status']) for item in history['items'])
+        return statuses, history.get('nextPage')
+    except (plistlib.InvalidFileException, xml.parsers.expat.ExpatError,
+            KeyError, TypeError, AttributeError):
+        log('Unrecognized notarization history output')
+        return {}, None
+
+
+class NotaryHistory(object):
+    '''Status of recent notary submissions, shared by every status check.
+
+    A single --notarization-history query covers every pending request,
+    instead of one credentialed altool launch per request. Later pages are
+    only read for requests missing from the pages read so far, up to
+    NOTARY_HISTORY_MAX_PAGES. The pages are reused until max_age seconds old,
+    and read by one caller while the others wait for them.
+    '''
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.statuses = {}
+        self.fetched_at = None
+        # None once the last page has been read
+        self.next_page = 0
+
+    def status(self, uuid):
+        '''Returns the status of request uuid, None if the history lacks it'''
+        uuid = uuid.lower()
+        with self.lock:
+            if self.fetched_at is None or time.time() - self.fetched_at >= self.max_age:
+                self.statuses = {}
+                self.next_page = 0
+                self.fetched_at = time.time()
+            while uuid not in self.statuses and self.next_page is not None \
+                    and self.next_page < NOTARY_HISTORY_MAX_PAGES:
+                statuses, self.next_page = fetch_notarization_history(self.next_page)
+                self.statuses.update(statuses)
+            return self.statuses.get(uuid)
 
 
 def notarize(archive_path):
@@ -535,252 +2609,1233 @@ def success_message(output_archive):
     log('Your notarization of %s was successful.' % output_archive)
 
 
+def sign_staged_binaries(staging_dirname, config):
+    '''Schedule signing of the binaries in config, returns list of futures'''
+    # Binaries sharing entitlements are signed in one batch, keyed by whether
+    # they have entitlements
+    batches = {False: [], True: []}
+    for key, with_entitlements in [('files', False), ('files_with_entitlements', True)]:
+        for entry in config.get(key, []):
+            if isinstance(entry, dict):
+                continue
+            absolute_path = os.path.join(staging_dirname, entry)
+            if not validate_binary_exists(absolute_path):
+                log_and_exit('Cannot find file %s from config' % absolute_path)
+            batch = batches[with_entitlements]
+            if absolute_path not in batch:
+                batch.append(absolute_path)
+    signing = []
+    for with_entitlements, paths in batches.items():
+        if paths:
+            signing += sign_in_parallel(paths, with_entitlements)
+    return signing
+
+
+def process_nested_zip(source, config, label, parent_dir):
+    '''Sign a nested zip held in a buffer, returns a buffer of the rebuilt zip
+
+    Only the binaries codesign needs are written to disk. Deeper nested zips
+    are handled the same way, and every rebuilt zip is spliced into its
+    parent as a buffer.
+    '''
+    staging_dirname = tempfile.mkdtemp(
+        prefix=os.path.basename(label) + '.',
+        suffix='.staging',
+        dir=STAGING_DIR or parent_dir)
+    names = get_binary_member_names(config)
+    before = zip_stats(source, label)
+    log('Extracting files to sign from %s...\n' % label)
+    if extract_members(source, names, staging_dirname, label) is None:
+        # Fall back to unzipping on disk
+        shutil.rmtree(staging_dirname)
+        zip_path = staging_dirname[:-len('.staging')] + '.zip'
+        with open(zip_path, 'wb') as target:
+            source.seek(0)
+            shutil.copyfileobj(source, target, 1024 * 1024)
+        process_zip(zip_path, config)
+        rebuilt = create_zip_buffer()
+        with open(zip_path, 'rb') as rebuilt_source:
+            shutil.copyfileobj(rebuilt_source, rebuilt, 1024 * 1024)
+        os.remove(zip_path)
+        return rebuilt
+
+    signing = sign_staged_binaries(staging_dirname, config)
+    replacements = {}
+    for name in names:
+        replacements[name] = os.path.join(staging_dirname, name)
+    with zipfile.ZipFile(source) as archive:
+        for next_config in get_nested_configs(config):
+            next_label = '%s/%s' % (label, next_config['path'])
+            log('Recursing for %s' % next_label)
+            replacements[next_config['path']] = process_nested_zip(
+                read_nested_zip(archive, next_config['path'], label),
+                next_config,
+                next_label,
+                parent_dir)
+    for future in signing:
+        future.result()
+    verify_staged_signatures(staging_dirname, config, label)
+
+    log('Rebuilding %s with signed files...\n' % label)
+    rebuilt = create_zip_buffer()
+    digests = {}
+    with pipeline_stage('repackage'):
+        if not rewrite_zip(source, replacements, rebuilt, digests):
+            log_and_exit('Cannot rebuild %s in memory' % label)
+    record_digests(label, digests, 'repackaged')
+    verify_zip_changes(
+        before,
+        zip_stats(rebuilt, label),
+        get_member_names(config),
+        label)
+    shutil.rmtree(staging_dirname)
+    return rebuilt
+
+
+@timed_function('process_zip')
 def process_zip(
         zip_path,
         config,
+        on_signed=None,
         ):
-    '''Recursive'''
-    shasum(zip_path)
-
-    log('Unzipping archive at %s...\n' % zip_path)
-    staging_dirname = unzip_archive(zip_path)
+    '''Recursive, returns digests of the repackaged zip
+
+    on_signed is called once every binary has been signed.
+    '''
+    before = zip_stats(zip_path, zip_path)
+
+    staging_dirname = None
+    if OPTIONS['extract_mode'] == 'selective':
+        log('Extracting files to sign from %s...\n' % zip_path)
+        staging_dirname = extract_members(
+            zip_path,
+            get_binary_member_names(config),
+            create_staging_name(zip_path),
+            zip_path)
+        if staging_dirname is None:
+            log('Falling back to extracting all of %s' % zip_path)
+    fully_extracted = staging_dirname is None
+    if fully_extracted:
+        log('Unzipping archive at %s...\n' % zip_path)
+        staging_dirname = unzip_archive(zip_path)
     if staging_dirname == None:
         log('Cancelling processing of %s' % zip_path)
         return
 
-    log('Validating config...\n')
-    files = [
-        {'path': path, 'entitlements': False} for path in config.get('files', [])]
-    files_with_entitlements = [
-        {'path': path, 'entitlements': True} for path in config.get('files_with_entitlements', [])]
-    all_files = files + files_with_entitlements
-    for file_dict in all_files:
-        if isinstance(file_dict['path'], dict):
-            continue
-        absolute_path = os.path.join(staging_dirname, file_dict['path'])
-        if not validate_binary_exists(absolute_path):
-            log_and_exit('Cannot find file %s from config' % absolute_path)
-
     log('Signing binaries...\n')
-    for file_dict in all_files:
-        if isinstance(file_dict['path'], dict):
-            next_config = file_dict['path']
+    signing = sign_staged_binaries(staging_dirname, config)
+    replacements = {}
+    for name in get_binary_member_names(config):
+        replacements[name] = os.path.join(staging_dirname, name)
+
+    # Nested zips are signed and rebuilt while the batches above run, and
+    # always before this zip is repackaged
+    for next_config in get_nested_configs(config):
+        if fully_extracted:
             next_zip_path = os.path.join(staging_dirname, next_config['path'])
             log('Recursing for %s' % next_zip_path)
+            # Not hashed on the way out, as unzip wrote it
+            shasum(next_zip_path, 'extracted')
             process_zip(next_zip_path, next_config)
+            replacements[next_config['path']] = next_zip_path
         else:
-            absolute_path = os.path.join(
-                staging_dirname,
-                file_dict['path'],
-                )
-            log('Signing %s...\n' % absolute_path)
-            sign(absolute_path, file_dict['entitlements'])
+            next_label = '%s/%s' % (zip_path, next_config['path'])
+            log('Recursing for %s' % next_label)
+            with zipfile.ZipFile(zip_path) as archive:
+                nested_source = read_nested_zip(archive, next_config['path'], zip_path)
+            replacements[next_config['path']] = process_nested_zip(
+                nested_source,
+                next_config,
+                next_label,
+                os.path.dirname(zip_path))
+    for future in signing:
+        future.result()
+    verify_staged_signatures(staging_dirname, config, zip_path)
+    if on_signed is not None:
+        on_signed()
 
     log('Updating %s with signed files...\n' % zip_path)
     # update downloaded zip
-    update_zip(staging_dirname, zip_path)
-    shasum(zip_path)
+    digests = repackage_zip(staging_dirname, zip_path, replacements)
+    verify_zip_changes(
+        before,
+        zip_stats(zip_path, zip_path),
+        get_member_names(config),
+        zip_path)
 
     log('Removing dir %s...\n' % staging_dirname)
     shutil.rmtree(staging_dirname)
 
     log('Finished processing %s...\n' % zip_path)
+    return digests
 
 
+@timed_function('process_archive')
 def process_archive(
         input_storage_base_url,
         output_storage_base_url,
         config,
         commit,
-        working_dir):
-    '''Main execution'''
+        working_dir,
+        stop=None):
+    '''Main execution
+
+    Raises Cancelled at the next stage once stop, an Event, is set.
+    '''
+    check_stopped(stop)
     input_cloud_path = '%s/%s/%s' % (
         input_storage_base_url,
         commit,
         config['path'])
 
-    unique_filename = get_unique_filename(config['path'])
-    zip_path = os.path.join(
-        working_dir,
-        unique_filename)
-
-    log('Beginning processing of %s...\n' % config['path'])
-
-    if not download(input_cloud_path, zip_path):
-        log('Download of %s failed, skipping.\n' % config['path'])
+    try:
+        unique_filename = get_unique_filename('%s/%s' % (commit, config['path']))
+        zip_path = os.path.join(
+            working_dir,
+            unique_filename)
+
+        log('Beginning processing of %s...\n' % config['path'])
+
+        output_cloud_path = '%s/%s/%s' % (
+            output_storage_base_url,
+            commit,
+            config['path'])
+
+        # Resume from the last stage recorded for this archive, as long as the
+        # zip on disk is still the one that was recorded
+        entry = JOURNAL.get(input_cloud_path)
+        if entry and not JOURNAL.reached(input_cloud_path, 'uploaded'):
+            if JOURNAL.reached(input_cloud_path, 'repackaged'):
+                recorded_sha256 = entry['repackaged_sha256']
+            else:
+                recorded_sha256 = entry['downloaded_sha256']
+            digests = hash_file(zip_path) if os.path.isfile(zip_path) else None
+            if digests is None or digests['sha256'] != recorded_sha256:
+                log('%s does not match the journal, starting over' % zip_path)
+                JOURNAL.reset(input_cloud_path)
+                entry = {}
+            else:
+                record_digests(zip_path, digests, 'resumed')
+        if not entry and os.path.isfile(zip_path):
+            os.remove(zip_path)
+        # Left behind if an earlier session stopped part way through signing
+        shutil.rmtree(create_staging_name(zip_path), ignore_errors=True)
+
+        # Inputs already notarized for an earlier revision only need copying
+        fingerprint = entry.get('fingerprint')
+        copied_from = None
+        if not entry and SIGNED_INDEX is not None:
+            fingerprint = input_fingerprint(input_cloud_path, config)
+            if fingerprint is not None:
+                copied_from = reuse_signed_output(fingerprint, output_cloud_path)
+
+        if copied_from:
+            log('%s is unchanged since it was signed as %s, reusing it' % (
+                config['path'],
+                copied_from))
+            JOURNAL.record(input_cloud_path, 'uploaded', copied_from=copied_from)
+        elif entry:
+            log('Resuming %s after stage %s' % (config['path'], entry['stage']))
+            if not JOURNAL.reached(input_cloud_path, 'uploaded'):
+                reserve_disk(input_cloud_path, archive_footprint(
+                    os.path.getsize(zip_path),
+                    JOURNAL.reached(input_cloud_path, 'repackaged')))
+        else:
+            check_stopped(stop)
+            if WORKING_SET is not None:
+                with METRICS.timed('stat'):
+                    metadata = STORAGE.stat(input_cloud_path)
+                reserve_disk(input_cloud_path, archive_footprint(
+                    metadata['size'] if metadata is not None else 0))
+            digests = download(input_cloud_path, zip_path)
+            if not digests:
+                release_disk(input_cloud_path)
+                log('Download of %s failed, skipping.\n' % config['path'])
+                return None
+            JOURNAL.record(
+                input_cloud_path,
+                'downloaded',
+                downloaded_sha256=digests['sha256'],
+                fingerprint=fingerprint)
+
+        if not JOURNAL.reached(input_cloud_path, 'repackaged'):
+            check_stopped(stop)
+            config = scan_for_unlisted_binaries(zip_path, config)
+            digests = process_zip(
+                zip_path,
+                config,
+                lambda: JOURNAL.record(input_cloud_path, 'signed'))
+            if digests is None:
+                release_disk(input_cloud_path)
+                log('Processing of %s failed, skipping.\n' % config['path'])
+                return None
+            JOURNAL.record(
+                input_cloud_path,
+                'repackaged',
+                repackaged_sha256=digests['sha256'])
+            reserve_disk(input_cloud_path, os.path.getsize(zip_path))
+
+        entry = JOURNAL.get(input_cloud_path)
+
+        # Return this dict for later verifying of the notarization & uploading,
+        # without a uuid until it has been submitted
+        request = {
+            'path': config['path'],
+            'revision': commit,
+            'input_cloud_path': input_cloud_path,
+            'output_cloud_path': output_cloud_path,
+            'uuid': entry.get('uuid'),
+            'submitted_at': entry.get('submitted_at'),
+            'zip_path': zip_path,
+            'fingerprint': entry.get('fingerprint'),
+            'batch': entry.get('batch'),
+            }
+        if 'copied_from' in entry:
+            request['copied_from'] = entry['copied_from']
+            return request
+        # Batched archives are submitted together once they are all signed
+        if not OPTIONS['batch_notarize'] and request['uuid'] is None:
+            check_stopped(stop)
+            submit_request(request)
+        return request
+
+    except BaseException:
+        release_disk(input_cloud_path)
+        raise
+
+
+def submit_request(request):
+    '''Submit a single top-level archive to the notary service'''
+    with log_context(archive=request['path'], revision=request['revision']):
+        log('Uploading %s to notary service...\n' % request['zip_path'])
+        with pipeline_stage('notarize'):
+            request['uuid'] = notarize(request['zip_path'])
+        request['submitted_at'] = time.time()
+        JOURNAL.record(
+            request['input_cloud_path'],
+            'submitted',
+            uuid=request['uuid'],
+            submitted_at=request['submitted_at'],
+            batch=None)
+        request['batch'] = None
+    return request
+
+
+def submit_individually(requests):
+    '''Submit each archive of a rejected batch on its own'''
+    log('Falling back to submitting %i archives individually' % len(requests))
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=stage_limits()['notarize']) as executor:
+        return list(executor.map(with_log_context(submit_request), requests))
+
+
+def submit_batch(requests, working_dir):
+    '''Submit signed archives to the notary service in one container zip
+
+    Returns a request for the whole batch, which is polled like any other
+    and uploads its archives once notarized, or None if the container could
+    not be submitted.
+    '''
+    handle, container_path = tempfile.mkstemp(
+        prefix='notarization_batch_',
+        suffix='.zip',
+        dir=working_dir)
+    os.close(handle)
+    log('Bundling %i archives into %s' % (len(requests), container_path))
+    with METRICS.timed('batch_container') as sample:
+        # The archives are already compressed, so store them as they are
+        with zipfile.ZipFile(
+                container_path,
+                'w',
+                zipfile.ZIP_STORED,
+                allowZip64=True) as container:
+            for request in requests:
+                container.write(
+                    request['zip_path'],
+                    os.path.basename(request['zip_path']))
+        sample['bytes'] = os.path.getsize(container_path)
+
+    with pipeline_stage('notarize'):
+        request_uuid = try_upload_zip_to_notary(container_path)
+    if request_uuid is None:
+        log('Batch submission of %s failed' % container_path)
         return None
-
-    output_cloud_path = '%s/%s/%s' % (
-        output_storage_base_url,
-        commit,
-        config['path'])
-
-    process_zip(zip_path, config)
-
-    # Only notarize & write logfile for top-level archives
-    log('Uploading %s to notary service...\n' % zip_path)
-    request_uuid = notarize(zip_path)
-
-    # Return this dict for later verifying of the notarization & uploading
-    return {
-        'output_cloud_path': output_cloud_path,
+    batch = {
+        'path': os.path.basename(container_path),
         'uuid': request_uuid,
-        'zip_path': zip_path,
+        'submitted_at': time.time(),
+        'zip_path': container_path,
+        'members': requests,
         }
+    # So that a resumed session polls the batch rather than resubmitting it
+    for request in requests:
+        request['uuid'] = request_uuid
+        request['submitted_at'] = batch['submitted_at']
+        request['batch'] = batch['path']
+        JOURNAL.record(
+            request['input_cloud_path'],
+            'submitted',
+            uuid=request_uuid,
+            submitted_at=batch['submitted_at'],
+            batch=batch['path'])
+    return batch
+
+
+def resume_batches(requests, working_dir):
+    '''Returns the batches of a resumed session that were submitted but not
+    yet notarized, rebuilt from the journal entries of their members'''
+    batches = collections.OrderedDict()
+    for request in requests:
+        batch = batches.setdefault(request['uuid'], {
+            'path': request['batch'],
+            'uuid': request['uuid'],
+            'submitted_at': request['submitted_at'],
+            'zip_path': os.path.join(working_dir, request['batch']),
+            'members': [],
+            })
+        batch['members'].append(request)
+    return list(batches.values())
 
 
 def verify_and_upload(request):
     '''Given a notarization request, check for its status & upload if done'''
-    # Only upload if notarization was successful
-    result = check_status(request['uuid'])
-    if result:
-        log('Uploading to %s' % request['output_cloud_path'])
-        upload(request['zip_path'], request['output_cloud_path'])
+    if 'members' in request:
+        return verify_and_upload_batch(request)
+    key = request['input_cloud_path']
+    with log_context(archive=request['path'], revision=request['revision']):
+        if not JOURNAL.reached(key, 'notarized'):
+            if not check_status(request['uuid']):
+                return False
+            METRICS.add('notary_wait', time.time() - request['submitted_at'])
+            JOURNAL.record(key, 'notarized')
+
+        # Only upload if notarization was successful, in the background so
+        # other requests keep being polled
+        if not JOURNAL.reached(key, 'uploaded'):
+            UPLOADS.submit(request)
+
+    return True
+
+
+def upload_request(request):
+    '''Upload a notarized archive to its output path'''
+    log('Uploading to %s' % request['output_cloud_path'])
+    try:
+        if not upload(request['zip_path'], request['output_cloud_path']):
+            return False
+        JOURNAL.record(request['input_cloud_path'], 'uploaded')
+        # Nothing needs the archive once it is uploaded
+        os.remove(request['zip_path'])
+    finally:
+        # A failed upload is left to the next session, which reserves again
+        release_disk(request['input_cloud_path'])
+    if SIGNED_INDEX is not None and request['fingerprint'] is not None:
+        output = STORAGE.stat(request['output_cloud_path'])
+        if output is not None:
+            SIGNED_INDEX.record(
+                request['fingerprint'],
+                input_cloud_path=request['input_cloud_path'],
+                output_cloud_path=request['output_cloud_path'],
+                output=output,
+                recorded_at=time.time())
+    return True
+
+
+class UploadPool(object):
+    '''Bounded pool uploading notarized archives in the background'''
+
+    def __init__(self, max_workers):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.uploads = {}
+
+    def submit(self, request):
+        '''Queue the upload of request, returns its future'''
+        future = self.executor.submit(with_log_context(upload_request), request)
+        with self.lock:
+            self.uploads[future] = request
+        return future
+
+    def wait(self, keys=None):
+        '''Wait for queued uploads, of the given input cloud paths or else of
+        all requests, returns the requests that failed'''
+        failed = []
+        with self.lock:
+            uploads = [
+                (future, request) for future, request in self.uploads.items()
+                if keys is None or request['input_cloud_path'] in keys]
+            for future, _ in uploads:
+                del self.uploads[future]
+        for future, request in uploads:
+            error = future.exception()
+            if error is not None:
+                log('Upload of %s raised %r' % (request['zip_path'], error))
+                failed.append(request)
+            elif not future.result():
+                failed.append(request)
+        return failed
+
+    def shutdown(self):
+        '''Stop taking uploads once the queued ones are done'''
+        self.executor.shutdown()
+
+    def abort(self):
+        '''Drop queued uploads without waiting for running ones'''
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class WorkingSet(object):
+    '''Bounds the disk taken by the archives being processed.
+
+    Each archive reserves its expected footprint before it is downloaded,
+    waiting while that would take the total past the budget, and gives it
+    back once it has been uploaded and deleted. A lone archive is always let
+    through, so a budget below the largest archive only serializes them.
+    '''
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.condition = threading.Condition()
+        self.reserved = {}
+
+    def reserve(self, key, size):
+        '''Hold size bytes for key once they fit in the budget, or at once
+        when resizing what key already holds'''
+        started_at = time.time()
+        with self.condition:
+            if key not in self.reserved and self.reserved \
+                    and sum(self.reserved.values()) + size > self.budget:
+                log('Waiting for %i MB of disk budget' % (size // (1024 * 1024)))
+                while self.reserved and sum(self.reserved.values()) + size > self.budget:
+                    self.condition.wait()
+                METRICS.add('disk_budget_wait', time.time() - started_at)
+            self.reserved[key] = size
+            self.condition.notify_all()
+
+    def release(self, key):
+        '''Give back the bytes held for key'''
+        with self.condition:
+            if self.reserved.pop(key, None) is not None:
+                self.condition.notify_all()
+
+
+def archive_footprint(size, repackaged=False):
+    '''Returns the disk a zip of size bytes takes while being processed'''
+    if repackaged:
+        return size
+    factor = ARCHIVE_FOOTPRINT_FACTOR
+    if STAGING_DIR is not None:
+        factor -= 1
+    return size * factor
+
+
+def reserve_disk(key, size):
+    '''Wait for size bytes of the disk budget, if any, to hold for key'''
+    if WORKING_SET is not None:
+        WORKING_SET.reserve(key, size)
+
+
+def release_disk(key):
+    '''Give back the disk budget held for key'''
+    if WORKING_SET is not None:
+        WORKING_SET.release(key)
+
+
+def verify_and_upload_batch(batch):
+    '''Check on a batch submission, uploading each of its archives if done'''
+    with log_context(archive=batch['path']):
+        status = notary_status(batch['uuid'])
+        # Unreadable output may be a transient altool or network failure,
+        # and the batch may still succeed, so leave it to the deadline
+        if status is None:
+            log('Unrecognized status of batch %s, checking again later' % batch['uuid'])
+            return False
+        if status == 'in progress':
+            log('Batch notarization is still pending...\n')
+            return False
+        if status != 'success':
+            log('Batch notarization failed with: %s' % status)
+            raise BatchNotarizationFailed(batch['members'])
+        METRICS.add('notary_wait', time.time() - batch['submitted_at'])
+
+    # Members carry the batch uuid so a resumed session does not resubmit
+    for request in batch['members']:
+        JOURNAL.record(
+            request['input_cloud_path'],
+            'notarized',
+            uuid=batch['uuid'],
+            submitted_at=batch['submitted_at'])
+        verify_and_upload(request)
+    return True
+
+
+class BatchNotarizationFailed(Exception):
+    '''Raised by the poller when the notary rejected a batch submission'''
+
+    def __init__(self, requests):
+        super(BatchNotarizationFailed, self).__init__(len(requests))
+        self.requests = requests
+
+
+class Cancelled(Exception):
+    '''Raised in an archive's worker once the run it belongs to has failed'''
+
+
+def check_stopped(stop):
+    '''Raise Cancelled if stop, an Event or None, is set'''
+    if stop is not None and stop.is_set():
+        log('Stopping, as the run has failed')
+        raise Cancelled()
+
+
+def stop_on_failure(stop, func, *args):
+    '''Run func, setting stop if it raises, so the rest of the run stops'''
+    try:
+        return func(*args)
+    except Cancelled:
+        raise
+    except BaseException:
+        stop.set()
+        raise
+
+
+class NotaryError(Exception):
+    '''Raised by the poller when a request failed, after logging why'''
+
+    def __init__(self, exit_code):
+        super(NotaryError, self).__init__(exit_code)
+        self.exit_code = exit_code
+
+
+class RateLimiter(object):
+    '''Allows at most max_calls acquisitions per sliding period of seconds,
+    shared by every thread'''
+
+    def __init__(self, max_calls, period):
+        self.max_calls = max_calls
+        self.period = period
+        self.calls = collections.deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''Wait until another call fits within the rate limit'''
+        with self.lock:
+            while len(self.calls) >= self.max_calls:
+                wait = self.calls[0] + self.period - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                self.calls.popleft()
+            self.calls.append(time.time())
+
+
+def throttle_notary_check():
+    '''Wait for the rate limit of altool status checks, if any'''
+    if NOTARY_CHECKS is not None:
+        NOTARY_CHECKS.acquire()
+
+
+def run_guarded(func, *args):
+    '''Run func, turning log_and_exit() into an exception for the event loop
+
+    SystemExit escaping a task would stop the whole event loop, so it is
+    carried back to the caller as a NotaryError instead.
+    '''
+    try:
+        return func(*args)
+    except SystemExit as error:
+        raise NotaryError(error.code)
+
+
+class NotaryPoller(object):
+    '''Polls the notary service for many requests concurrently.
+
+    Each request gets its own backoff schedule and deadline, and a request is
+    queued for upload as soon as its notarization succeeds. Only the altool
+    launches behind the status checks share a global rate limit, see
+    throttle_notary_check(). The event loop runs on a background thread, so
+    requests can be handed over while other archives are still processing.
+    '''
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def watch(self, request):
+        '''Start polling request, returns a future resolving once notarized'''
+        # Checks run on the loop's executor, so carry the log context, such
+        # as the daemon job, of whoever handed the request over
+        return asyncio.run_coroutine_threadsafe(
+            self.poll(request, with_log_context(run_guarded)),
+            self.loop)
+
+    async def poll(self, request, guarded):
+        '''Check request with backoff until it succeeds or its deadline passes,
+        calling each check through guarded, i.e. run_guarded()'''
+        # Requests resumed from an earlier session may already be due
+        submitted_at = request['submitted_at']
+        deadline = submitted_at + OPTIONS['notary_deadline']
+        delay = submitted_at + OPTIONS['notary_initial_delay'] - time.time()
+        interval = OPTIONS['notary_poll_interval']
+        while True:
+            delay = min(delay, deadline - time.time())
+            if delay > 0:
+                await asyncio.sleep(delay)
+            done = await self.loop.run_in_executor(
+                None,
+                guarded,
+                verify_and_upload,
+                request)
+            if done:
+                return True
+            if time.time() >= deadline:
+                await self.loop.run_in_executor(
+                    None,
+                    guarded,
+                    log_and_exit,
+                    'Notarization of %s did not finish within %i seconds' % (
+                        request['zip_path'],
+                        OPTIONS['notary_deadline']))
+            delay = interval
+            interval = min(
+                interval * NOTARY_BACKOFF_FACTOR,
+                OPTIONS['notary_max_poll_interval'])
+
+    def shutdown(self):
+        '''Stop the event loop'''
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def validate_revision(revision):
+    '''Raise ValueError unless revision is safe to put into paths'''
+    if not re.search(r'^[\w.-]+$', revision) or revision.startswith('-'):
+        raise ValueError('Invalid revision "%s"' % revision)
+
+
+def plan_archives(args, bucket_prefix):
+    '''Returns (revision, name, input base, output base, config) of every
+    archive to sign, given engine revisions and --<dependency> <revision>
+    pairs in any order. Raises ValueError if args do not parse.'''
+    plan = []
+    index = 0
+    while index < len(args):
+        switch = re.search('^--([a-z-]+)$', args[index])
+        if switch:
+            name = switch.group(1)
+            archive = LIBIMOBILEDEVICE_ARCHIVES.get(name)
+            if archive is None:
+                raise ValueError('Unknown option %s' % args[index])
+            if index + 1 >= len(args):
+                raise ValueError('Missing revision for %s' % args[index])
+            validate_revision(args[index + 1])
+            plan.append((
+                args[index + 1],
+                name,
+                'gs://%s/ios-usb-dependencies/unsigned/%s' % (bucket_prefix, name),
+                'gs://%s/ios-usb-dependencies/%s' % (bucket_prefix, name),
+                archive))
+            index += 2
+            continue
+        validate_revision(args[index])
+        for archive in ARCHIVES:
+            plan.append((
+                args[index],
+                archive['path'],
+                'gs://%s/flutter' % bucket_prefix,
+                'gs://%s/flutter' % bucket_prefix,
+                archive))
+        index += 1
+    return plan
 
-    return result
 
+def unique_revisions(archives):
+    '''Returns the revisions of (revision, ...) tuples, in order of appearance'''
+    return list(collections.OrderedDict(
+        (archive[0], None) for archive in archives))
 
-def main(args, bucket_prefix):
-    '''Application entrypoint'''
+
+def revision_outcomes(result):
+    '''Maps each revision of a run_plan() result to its archives' outcomes'''
+    outcomes = collections.OrderedDict()
+    for revision, name in result['archives']:
+        if (revision, name) in result['skipped']:
+            outcome = 'skipped, not found on cloud storage'
+        elif (revision, name) in result['reused']:
+            outcome = 'reused, unchanged since an earlier revision'
+        else:
+            outcome = 'notarized and uploaded'
+        outcomes.setdefault(revision, collections.OrderedDict())[name] = outcome
+    return outcomes
+
+
+def report_revisions(result):
+    '''Log what became of every archive of a run_plan() result, per revision'''
+    for revision, archives in revision_outcomes(result).items():
+        lines = ['Revision %s:' % revision]
+        for name, outcome in archives.items():
+            lines.append('    %s: %s' % (name, outcome))
+        log('\n'.join(lines))
+
+
+def setup():
+    '''Create the state shared by every archive signed in this process:
+    storage, caches, pools and the session journal. Returns the working dir'''
+    global PIPELINE, SIGN_CACHE, SIGN_EXECUTOR, STORAGE, SIGNED_INDEX, UPLOADS
+    global JOURNAL, WORKING_SET, STAGING_DIR, NOTARY_HISTORY, NOTARY_CHECKS
+    if OPTIONS['unlisted_binaries'] not in UNLISTED_BINARY_MODES:
+        log_and_exit('--unlisted-binaries must be one of %s' % ', '.join(UNLISTED_BINARY_MODES))
     ensure_entitlements_file()
+    STORAGE = create_storage()
+    if OPTIONS['signed_index']:
+        SIGNED_INDEX = SignedIndex(OPTIONS['signed_index'])
+    PIPELINE = Pipeline(stage_limits())
+    UPLOADS = UploadPool(stage_limits()['upload'])
+    SIGN_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+        max_workers=stage_limits()['sign'])
+    if OPTIONS['sign_cache_mb'] > 0:
+        SIGN_CACHE = SigningCache(
+            OPTIONS['sign_cache_dir'],
+            OPTIONS['sign_cache_mb'] * 1024 * 1024)
 
     print('Clean build folders...\n')
     working_dir = create_working_dir(CWD)
+    JOURNAL = Journal(os.path.join(working_dir, 'journal.json'))
+    if OPTIONS['disk_budget_mb'] > 0:
+        # Batched archives are all kept until the last one is signed
+        if OPTIONS['batch_notarize']:
+            log_and_exit('--disk-budget-mb cannot be combined with --batch-notarize')
+        WORKING_SET = WorkingSet(OPTIONS['disk_budget_mb'] * 1024 * 1024)
+    NOTARY_CHECKS = RateLimiter(max(1, OPTIONS['notary_checks_per_minute']), 60)
+    if OPTIONS['notary_history']:
+        # Fresh enough that no request is checked on a stale status twice
+        NOTARY_HISTORY = NotaryHistory(OPTIONS['notary_poll_interval'] / 2.0)
+    if OPTIONS['staging_dir']:
+        if not os.path.isdir(OPTIONS['staging_dir']):
+            log_and_exit('--staging-dir %s does not exist' % OPTIONS['staging_dir'])
+        # Named after the session, so resuming finds its leftovers
+        STAGING_DIR = os.path.join(
+            os.path.abspath(OPTIONS['staging_dir']),
+            os.path.basename(working_dir))
+        os.makedirs(STAGING_DIR, exist_ok=True)
+    return working_dir
+
+
+def abort_pools():
+    '''Drop queued work from every pool and kill the tools running, after a
+    fatal error or Ctrl-C'''
+    STOP.set()
+    kill_commands()
+    PIPELINE.abort()
+    SIGN_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+    UPLOADS.abort()
+
+
+def abandon_plan(futures, watches, keys, stop, error):
+    '''Stop what is left of a failed plan
+
+    Its other archives stop at their next stage and its notarizations are
+    no longer polled. A daemon carries on running other jobs on the same
+    pools, so it also gives back the disk held by the plan, once uploads
+    already under way are done, and waits for the other archives to stop.
+    '''
+    stop.set()
+    for watch in watches:
+        watch.cancel()
+    if JOBS is None or isinstance(error, KeyboardInterrupt):
+        return
+    UPLOADS.wait(keys)
+    for key in keys:
+        release_disk(key)
+    # Released first, as archives may be waiting for that disk
+    for future in futures:
+        try:
+            request = future.result()
+        except BaseException:
+            continue
+        if request is not None:
+            release_disk(request['input_cloud_path'])
+
+
+def run_plan(plan, working_dir, poller, stop):
+    '''Sign, notarize & upload every archive of a plan_archives() plan
+
+    Returns a dict of the (revision, name) of every archive, those skipped
+    and reused, the requests whose upload failed, and the files left in
+    working_dir. Raises NotaryError if notarization failed. stop is set as
+    soon as any archive or notarization fails, which stops the others.
+    '''
+    # Maps pending process_archive() futures to (revision, archive name)
+    futures = {}
+    for revision, name, input_base, output_base, config in plan:
+        with log_context(archive=config['path'], revision=revision):
+            futures[PIPELINE.submit(
+                stop_on_failure,
+                stop,
+                process_archive,
+                input_base,
+                output_base,
+                config,
+                revision,
+                working_dir,
+                stop)] = (revision, name)
+
+    # Start polling each request as soon as it has been submitted
+    result = {
+        'archives': list(futures.values()),
+        'skipped': [],
+        'reused': [],
+        'failed_uploads': [],
+        'files': [],
+        }
+    keys = set()
+    watches = []
+    # Archives held back for a single batch submission
+    batched = []
+    # Members of batches submitted by the session being resumed
+    resumed = []
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            request = future.result()
+            if request is None:
+                result['skipped'].append(futures[future])
+                continue
+            keys.add(request['input_cloud_path'])
+            result['files'].append(request['zip_path'])
+            if 'copied_from' in request:
+                result['reused'].append(futures[future])
+            elif request['uuid'] is None:
+                batched.append(request)
+            elif request['batch'] and not JOURNAL.reached(
+                    request['input_cloud_path'], 'notarized'):
+                resumed.append(request)
+            else:
+                watches.append(poller.watch(request))
+        for batch in resume_batches(resumed, working_dir):
+            result['files'].append(batch['zip_path'])
+            watches.append(poller.watch(batch))
+        if batched:
+            batch = submit_batch(batched, working_dir)
+            if batch is None:
+                batched = submit_individually(batched)
+            else:
+                result['files'].append(batch['zip_path'])
+                batched = [batch]
+            watches.extend(poller.watch(request) for request in batched)
+        log('%i requests submitted, waiting on the notary service' % len(watches))
+        # Whichever request fails first ends the wait, rather than only once
+        # every request submitted before it has finished
+        pending = set(watches)
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending,
+                return_when=concurrent.futures.FIRST_EXCEPTION)
+            for watch in done:
+                try:
+                    watch.result()
+                except BatchNotarizationFailed as failure:
+                    retries = [
+                        poller.watch(request)
+                        for request in submit_individually(failure.requests)]
+                    watches.extend(retries)
+                    pending.update(retries)
+    except BaseException as error:
+        abandon_plan(futures, watches, keys, stop, error)
+        raise
+    result['failed_uploads'] = UPLOADS.wait(keys)
+    return result
+
 
-    requests = []
-    skipped_archives = []
+def main(args, bucket_prefix):
+    '''Application entrypoint'''
+    working_dir = setup()
 
-    optional_switch = re.search('^--([a-z-]+)', args[0])
+    plan = []
     if args[0] == '--verify':
         request_uuid = args[1]
         check_status(request_uuid)
-    elif optional_switch:
-        name = optional_switch.group(1)
-        libimobiledevice_archives = {
-            'ios-deploy': {
-                'path': 'ios-deploy.zip',
-                'files': ['ios-deploy'],
-                },
-            'libimobiledevice': {
-                'path': 'libimobiledevice.zip',
-                'files_with_entitlements': [
-                    'idevicescreenshot',
-                    'idevicesyslog',
-                    'libimobiledevice-1.0.6.dylib',
-                    ],
-                },
-            'libplist': {
-                'path': 'libplist.zip',
-                'files_with_entitlements': [
-                    'libplist-2.0.3.dylib',
-                    ],
-                },
-            'usbmuxd': {
-                'path': 'usbmuxd.zip',
-                'files_with_entitlements': [
-                    'iproxy',
-                    'libusbmuxd-2.0.6.dylib',
-                    ],
-                },
-            'openssl': {
-                'path': 'openssl.zip',
-                'files_with_entitlements': [
-                    'libssl.1.1.dylib',
-                    'libcrypto.1.1.dylib',
-                    ],
-                },
-            }
-        archive = libimobiledevice_archives[name]
-        if not archive:
-            log('Unknown option %s' % args[0])
-            exit(1)
-        request = process_archive(
-            'gs://%s/ios-usb-dependencies/unsigned/%s' % (bucket_prefix, name),
-            'gs://%s/ios-usb-dependencies/%s' % (bucket_prefix, name),
-            libimobiledevice_archives[name],
-            args[1],
-            working_dir,
-        )
-        if request == None:
-            skipped_archives.append(name)
-        else:
-            requests.append(request)
     else:
-        engine_revision = args[0]
-        requests = []
-        log('Beginning codesigning of engine revision %s' % engine_revision)
-        for archive in ARCHIVES:
-            requests.append(process_archive(
-                'gs://%s/flutter' % bucket_prefix,
-                'gs://%s/flutter' % bucket_prefix,
-                archive,
-                engine_revision,
-                working_dir))
+        try:
+            plan = plan_archives(args, bucket_prefix)
+        except ValueError as error:
+            log_and_exit(str(error))
+        for revision in unique_revisions(plan):
+            log('Beginning codesigning of revision %s' % revision)
+
+    poller = NotaryPoller()
+    try:
+        result = run_plan(plan, working_dir, poller, STOP)
+        PIPELINE.shutdown()
+        SIGN_EXECUTOR.shutdown()
+        UPLOADS.shutdown()
+    except NotaryError as error:
+        abort_pools()
+        exit(error.exit_code)
+    except Cancelled:
+        # Whatever failed has already logged why
+        abort_pools()
+        exit(1)
+    except BaseException:
+        abort_pools()
+        raise
+    finally:
+        poller.shutdown()
 
-    index = 0
-    last_at_zero = time.time()
-
-    # Sleep here so that we never check for a job before it has been started,
-    # leading to an error from the notary service.
-    time.sleep(45)
-
-    # Minimum time between successive requests for the same archive
-    timeout_seconds = 20
-
-    # Iterate until requests is empty
-    while requests:
-        now = time.time()
-        log('%i requests left' % len(requests))
-        time_since_last_at_zero = now - last_at_zero
-        # Ensure we never hit server more than twice in 10 seconds
-        # for a particular request
-        if time_since_last_at_zero < timeout_seconds:
-            timeout = timeout_seconds - time_since_last_at_zero
-            log('Waiting %i seconds until next check...' % timeout)
-            time.sleep(timeout)
-
-        request = requests[index]
-        if verify_and_upload(request):
-            # remove from list...same index now points to next request...
-            requests.remove(request)
-        else:
-            # Leave in list but move on to next request
-            index += 1
-        if index >= len(requests):
-            index = 0
-            last_at_zero = time.time()
+    # Keep working_dir around so the failed uploads can be resumed
+    if len(result['failed_uploads']) > 0:
+        log_and_exit('Failed to upload the following archives:\n%s' % '\n'.join(
+            request['output_cloud_path'] for request in result['failed_uploads']))
 
     # Clean up signed binaries
     shutil.rmtree(working_dir)
+    if STAGING_DIR is not None:
+        shutil.rmtree(STAGING_DIR)
 
-    if len(skipped_archives) > 0:
-        log('Skipped the following archives which were not found on '
-                'cloud storage:\n%s' % '\n'.join(skipped_archives))
+    if SIGN_CACHE is not None:
+        log(SIGN_CACHE.summary())
 
-    log('Codesigning & Notarization successful')
+    report_revisions(result)
 
+    log('Codesigning & Notarization successful')
 
-# validations
-for key in [
-        'APP_SPECIFIC_PASSWORD',
-        'CODESIGN_USERNAME',
-        'CODESIGN_CERT_NAME']:
-    if os.environ.get(key, None) is None:
-        print('Please provide the env variable %s' % key)
-        exit(1)
 
-APP_SPECIFIC_PASSWORD = os.environ['APP_SPECIFIC_PASSWORD']
+class JobQueue(object):
+    '''Signing jobs taken by the daemon, run highest priority first.
+
+    Each job is a list of arguments as taken by main(). Up to daemon_jobs
+    jobs run at once on worker threads, all sharing the pools, caches and
+    notary poller set up when the daemon started. Submitting the same
+    arguments as a queued or running job returns that job instead.
+    '''
+
+    def __init__(self, working_dir, poller, bucket_prefix):
+        self.working_dir = working_dir
+        self.poller = poller
+        self.bucket_prefix = bucket_prefix
+        self.condition = threading.Condition()
+        self.ids = itertools.count(1)
+        self.queue = []
+        self.jobs = collections.OrderedDict()
+        for _ in range(max(1, OPTIONS['daemon_jobs'])):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, args, priority=0):
+        '''Queue a job, returns its status. Raises ValueError for bad args'''
+        plan = plan_archives(args, self.bucket_prefix)
+        with self.condition:
+            for job in self.jobs.values():
+                if job['args'] == args and job['state'] in ['queued', 'running']:
+                    return dict(job)
+            job = {
+                'id': next(self.ids),
+                'args': args,
+                'priority': priority,
+                'state': 'queued',
+                'submitted_at': time.time(),
+                'started_at': None,
+                'finished_at': None,
+                'revisions': None,
+                'error': None,
+                }
+            self.jobs[job['id']] = job
+            heapq.heappush(self.queue, (-priority, job['id'], plan))
+            self.condition.notify()
+            log('Queued job %i: %s' % (job['id'], ' '.join(args)))
+            return dict(job)
+
+    def status(self, job_id=None):
+        '''Returns the status of one job, None if unknown, or else of all'''
+        with self.condition:
+            if job_id is None:
+                return [dict(job) for job in self.jobs.values()]
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def work(self):
+        '''Worker thread body'''
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                _, job_id, plan = heapq.heappop(self.queue)
+                job = self.jobs[job_id]
+                job['state'] = 'running'
+                job['started_at'] = time.time()
+            with log_context(job=job_id):
+                outcome = self.run(plan)
+            self.write_logs(job_id)
+            self.forget_uploaded(plan)
+            with self.condition:
+                job.update(outcome)
+                job['finished_at'] = time.time()
+            log('Job %i %s' % (job_id, outcome['state']))
+
+    def run(self, plan):
+        '''Run a job's plan, returns the fields to update its status with'''
+        # Stops the job's other archives once one fails, leaving other jobs be
+        stop = threading.Event()
+        try:
+            result = run_plan(plan, self.working_dir, self.poller, stop)
+        except NotaryError:
+            return {'state': 'failed', 'error': 'Notarization failed'}
+        except Cancelled:
+            return {'state': 'failed', 'error': 'Cancelled as another archive failed'}
+        except SystemExit as error:
+            return {'state': 'failed', 'error': 'Exited with %s' % error.code}
+        except Exception as error:
+            log('Job raised %r' % error)
+            return {'state': 'failed', 'error': repr(error)}
+        if len(result['skipped']) == len(result['archives']):
+            return {
+                'state': 'failed',
+                'revisions': revision_outcomes(result),
+                'error': 'No archive was found on cloud storage',
+                }
+        if len(result['failed_uploads']) > 0:
+            # Left in working_dir, so submitting the job again resumes it
+            return {
+                'state': 'failed',
+                'revisions': revision_outcomes(result),
+                'error': 'Failed to upload %s' % ', '.join(
+                    request['output_cloud_path']
+                    for request in result['failed_uploads']),
+                }
+        for path in result['files']:
+            if os.path.isfile(path):
+                os.remove(path)
+        return {'state': 'succeeded', 'revisions': revision_outcomes(result)}
+
+    def forget_uploaded(self, plan):
+        '''Drop the journal entries of the archives of a finished job that
+        were uploaded, so that the journal only holds archives still to
+        finish, and submitting the same revisions again signs them again'''
+        uploaded = []
+        for revision, _, input_base, _, config in plan:
+            key = '%s/%s/%s' % (input_base, revision, config['path'])
+            if JOURNAL.reached(key, 'uploaded'):
+                uploaded.append(key)
+        if uploaded:
+            JOURNAL.forget(uploaded)
+
+    def write_logs(self, job_id):
+        '''Write the manifest and metrics of a finished job to a directory of
+        its own in the logs, and stop keeping them'''
+        log_dir = os.path.join(get_logs_dir(), 'job_%i' % job_id)
+        os.makedirs(log_dir, exist_ok=True)
+        write_manifest(os.path.join(log_dir, 'manifest.json'), job_id)
+        METRICS.write(log_dir, job_id)
+        METRICS.reset(job_id)
+
+
+class DaemonRequestHandler(http.server.BaseHTTPRequestHandler):
+    '''JSON API of the daemon, see usage()'''
+
+    def do_GET(self):
+        if self.path == '/jobs':
+            return self.reply(200, JOBS.status())
+        match = re.search('^/jobs/([0-9]+)$', self.path)
+        job = JOBS.status(int(match.group(1))) if match else None
+        if job is None:
+            return self.reply(404, {'error': 'No such job %s' % self.path})
+        return self.reply(200, job)
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            return self.reply(404, {'error': 'No such endpoint %s' % self.path})
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            args = body['args']
+            if not isinstance(args, list) or not args or not all(
+                    isinstance(arg, str) for arg in args):
+                raise ValueError('args must be a non-empty list of revisions')
+            job = JOBS.submit(args, int(body.get('priority', 0)))
+        except (KeyError, TypeError, ValueError) as error:
+            return self.reply(400, {'error': str(error)})
+        return self.reply(202, job)
+
+    def reply(self, code, body):
+        data = json.dumps(body, indent=1).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        log('%s %s' % (self.address_string(), format % args))
+
+
+def interrupt(signum, frame):
+    '''Signal handler stopping the daemon like Ctrl-C does'''
+    raise KeyboardInterrupt()
+
+
+def serve(bucket_prefix):
+    '''Run as a daemon taking signing jobs over HTTP, until interrupted'''
+    global JOBS
+    signal.signal(signal.SIGTERM, interrupt)
+    working_dir = setup()
+    poller = NotaryPoller()
+    JOBS = JobQueue(working_dir, poller, bucket_prefix)
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', OPTIONS['daemon_port']),
+        DaemonRequestHandler)
+    log('Taking signing jobs on http://127.0.0.1:%i/jobs' % server.server_port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log('Interrupted, abandoning %i unfinished jobs' % len([
+            job for job in JOBS.status()
+            if job['state'] in ['queued', 'running']]))
+    finally:
+        server.server_close()
+        abort_pools()
+        poller.shutdown()
+        JOBS = None
+
+
+# As shipped with the Xcode Command Line Tools
+MINIMUM_PYTHON = (3, 9)
+
+APP_SPECIFIC_PASSWORD = os.environ.get('APP_SPECIFIC_PASSWORD')
 CODESIGN_PRIMARY_BUNDLE_ID = os.environ.get(
     'CODESIGN_PRIMARY_BUNDLE_ID',
     'dev.flutter.tools')
-CODESIGN_USERNAME = os.environ['CODESIGN_USERNAME']
-CODESIGN_CERT_NAME = os.environ['CODESIGN_CERT_NAME']
+CODESIGN_USERNAME = os.environ.get('CODESIGN_USERNAME')
+CODESIGN_CERT_NAME = os.environ.get('CODESIGN_CERT_NAME')
+
+
+def validate_environment():
+    '''Exit unless the required env variables are set'''
+    for key in [
+            'APP_SPECIFIC_PASSWORD',
+            'CODESIGN_USERNAME',
+            'CODESIGN_CERT_NAME']:
+        if os.environ.get(key, None) is None:
+            print('Please provide the env variable %s' % key)
+            exit(1)
 
 
-if len(sys.argv) == 1:
-    usage()
-    exit(1)
+# Guarded so that tooling, e.g. benchmark.py, can import ARCHIVES
+if __name__ == '__main__':
+    if sys.version_info < MINIMUM_PYTHON:
+        print('Python %i.%i or newer is needed' % MINIMUM_PYTHON)
+        exit(1)
+    validate_environment()
 
-main(sys.argv[1:], 'flutter_infra_release')
+    ARGS = parse_options(sys.argv[1:])
+
+    if OPTIONS['daemon']:
+        serve('flutter_infra_release')
+    elif not ARGS:
+        usage()
+        exit(1)
+    else:
+        main(ARGS, 'flutter_infra_release')
 
-log_and_exit('Success', 0, 'notarization.log')
+    log_and_exit('Success', 0, 'notarization.log')
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+'''Tests of codesign.py that need neither Xcode nor credentials
+
+The fixture binaries come from the stand-in tools of benchmark.py, so this
+runs on plain Linux:
+    python3 -m unittest test_codesign
+'''
+
+import io
+import os
+import plistlib
+import random
+import threading
+import time
+import unittest
+import zipfile
+from unittest import mock
+
+import benchmark
+import codesign
+from benchmark import CPU_TYPE_ARM64
+from benchmark import CPU_TYPE_X86_64
+from benchmark import FAT_MAGIC_64
+from benchmark import MH_DYLIB
+from benchmark import MH_EXECUTE
+
+
+class SignatureProblemsTest(unittest.TestCase):
+    '''signature_problems() on each kind of bad signature'''
+
+    def setUp(self):
+        self.rng = random.Random(0)
+        with open(os.path.join(benchmark.HERE, 'Entitlements.plist'), 'rb') as plist:
+            self.entitlements = plist.read()
+        self.expected = plistlib.loads(self.entitlements)
+
+    def unsigned(self, cputype=CPU_TYPE_ARM64):
+        return benchmark.thin_binary(self.rng, cputype, MH_EXECUTE, 4096)
+
+    def signed(self, cputype=CPU_TYPE_ARM64, **fields):
+        signature = dict(
+            identifier='fixture',
+            entitlements=self.entitlements,
+            runtime=True,
+            timestamp=True)
+        signature.update(fields)
+        return benchmark.sign_slice(
+            self.unsigned(cputype),
+            benchmark.code_signature(**signature))
+
+    def problems(self, data, entitlements):
+        return codesign.signature_problems(io.BytesIO(data), entitlements)
+
+    def test_valid(self):
+        self.assertEqual(self.problems(self.signed(), self.expected), [])
+
+    def test_valid_without_entitlements(self):
+        self.assertEqual(self.problems(self.signed(entitlements=None), None), [])
+
+    def test_unsigned(self):
+        self.assertEqual(
+            self.problems(self.unsigned(), self.expected),
+            ['arm64 slice is not signed'])
+
+    def test_ad_hoc(self):
+        self.assertEqual(
+            self.problems(self.signed(adhoc=True), self.expected),
+            ['arm64 slice is only signed ad hoc',
+             'arm64 slice lacks a secure timestamp'])
+
+    def test_no_hardened_runtime(self):
+        self.assertEqual(
+            self.problems(self.signed(runtime=False), self.expected),
+            ['arm64 slice lacks the hardened runtime'])
+
+    def test_no_timestamp(self):
+        self.assertEqual(
+            self.problems(self.signed(timestamp=False), self.expected),
+            ['arm64 slice lacks a secure timestamp'])
+
+    def test_missing_entitlements(self):
+        self.assertEqual(
+            self.problems(self.signed(entitlements=None), self.expected),
+            ['arm64 slice lacks entitlements'])
+
+    def test_unexpected_entitlements(self):
+        self.assertEqual(
+            self.problems(self.signed(), None),
+            ['arm64 slice carries unexpected entitlements'])
+
+    def test_different_entitlements(self):
+        other = plistlib.dumps({'com.apple.security.cs.allow-jit': True})
+        self.assertEqual(
+            self.problems(self.signed(entitlements=other), self.expected),
+            ['arm64 slice carries different entitlements'])
+
+    def test_fat(self):
+        data = benchmark.fat_binary([self.signed(CPU_TYPE_X86_64), self.signed()])
+        self.assertEqual(self.problems(data, self.expected), [])
+
+    def test_fat_with_unsigned_slice(self):
+        data = benchmark.fat_binary([self.unsigned(CPU_TYPE_X86_64), self.signed()])
+        self.assertEqual(
+            self.problems(data, self.expected),
+            ['x86_64 slice is not signed'])
+
+    def test_fat_64(self):
+        data = benchmark.fat_binary(
+            [self.signed(CPU_TYPE_X86_64), self.signed()],
+            FAT_MAGIC_64)
+        self.assertEqual(self.problems(data, self.expected), [])
+
+    def test_fat_64_without_runtime(self):
+        data = benchmark.fat_binary(
+            [self.signed(CPU_TYPE_X86_64), self.signed(runtime=False)],
+            FAT_MAGIC_64)
+        self.assertEqual(
+            self.problems(data, self.expected),
+            ['arm64 slice lacks the hardened runtime'])
+
+    def test_not_macho(self):
+        problems = self.problems(b'not a binary', None)
+        self.assertEqual(len(problems), 1)
+        self.assertTrue(problems[0].startswith('cannot be parsed, '))
+
+
+def zip_bytes(members):
+    '''Returns a zip of the given name to bytes dict'''
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+class FindUnlistedBinariesTest(unittest.TestCase):
+    '''find_unlisted_binaries() on zips nesting other zips'''
+
+    def setUp(self):
+        rng = random.Random(0)
+        self.binary = benchmark.thin_binary(rng, CPU_TYPE_ARM64, MH_EXECUTE, 4096)
+        self.dylib = benchmark.thin_binary(rng, CPU_TYPE_ARM64, MH_DYLIB, 4096)
+        self.config = {
+            'path': 'darwin-x64/FlutterMacOS.framework.zip',
+            'files': [
+                {
+                    'path': 'FlutterMacOS.framework.zip',
+                    'files': ['Versions/A/FlutterMacOS'],
+                    },
+                ],
+            }
+
+    def find(self, members):
+        return codesign.find_unlisted_binaries(
+            io.BytesIO(zip_bytes(members)),
+            self.config,
+            self.config['path'])
+
+    def test_all_listed(self):
+        framework = zip_bytes({
+            'Versions/A/FlutterMacOS': self.binary,
+            'Versions/A/Resources/Info.plist': b'<plist/>',
+            })
+        unlisted, extended = self.find({'FlutterMacOS.framework.zip': framework})
+        self.assertEqual(unlisted, [])
+        self.assertEqual(extended, self.config)
+
+    def test_unlisted_in_listed_nested_zip(self):
+        framework = zip_bytes({
+            'Versions/A/FlutterMacOS': self.binary,
+            'Versions/A/libextra.dylib': self.dylib,
+            })
+        unlisted, extended = self.find({'FlutterMacOS.framework.zip': framework})
+        self.assertEqual(unlisted, [
+            'darwin-x64/FlutterMacOS.framework.zip/'
+            'FlutterMacOS.framework.zip/Versions/A/libextra.dylib'])
+        self.assertEqual(extended['files'], [{
+            'path': 'FlutterMacOS.framework.zip',
+            'files': ['Versions/A/FlutterMacOS', 'Versions/A/libextra.dylib'],
+            }])
+
+    def test_unlisted_in_unlisted_nested_zip(self):
+        framework = zip_bytes({'Versions/A/FlutterMacOS': self.binary})
+        unlisted, extended = self.find({
+            'FlutterMacOS.framework.zip': framework,
+            'tools.zip': zip_bytes({'bin/tool': self.binary, 'README': b'tool'}),
+            'libextra.dylib': self.dylib,
+            })
+        self.assertEqual(unlisted, [
+            'darwin-x64/FlutterMacOS.framework.zip/tools.zip/bin/tool',
+            'darwin-x64/FlutterMacOS.framework.zip/libextra.dylib'])
+        self.assertEqual(extended['files'][1:], [
+            {'path': 'tools.zip', 'files': ['bin/tool']},
+            'libextra.dylib'])
+
+
+class RateLimiterTest(unittest.TestCase):
+    '''RateLimiter shared by several threads'''
+
+    def test_contended(self):
+        limiter = codesign.RateLimiter(2, 0.2)
+        threads = [threading.Thread(target=limiter.acquire) for _ in range(3)]
+        started_at = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreaterEqual(time.time() - started_at, 0.2)
+
+
+class NotaryHistoryTest(unittest.TestCase):
+    '''NotaryHistory reading pages of a stand-in history'''
+
+    def setUp(self):
+        self.fetched = []
+        self.pages = [{'a': 'success'}, {'b': 'in progress'}, {'c': 'invalid'}]
+        patcher = mock.patch.object(
+            codesign, 'fetch_notarization_history', self.fetch)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch(self, page):
+        self.fetched.append(page)
+        next_page = page + 1 if page + 1 < len(self.pages) else None
+        return self.pages[page], next_page
+
+    def test_first_page(self):
+        history = codesign.NotaryHistory(60)
+        self.assertEqual(history.status('A'), 'success')
+        self.assertEqual(self.fetched, [0])
+
+    def test_later_pages_only_when_missing(self):
+        history = codesign.NotaryHistory(60)
+        self.assertEqual(history.status('c'), 'invalid')
+        self.assertEqual(history.status('b'), 'in progress')
+        self.assertEqual(history.status('a'), 'success')
+        self.assertEqual(self.fetched, [0, 1, 2])
+
+    def test_missing(self):
+        history = codesign.NotaryHistory(60)
+        self.assertIsNone(history.status('d'))
+        self.assertIsNone(history.status('d'))
+        self.assertEqual(self.fetched, [0, 1, 2])
+
+    def test_page_limit(self):
+        self.pages = [{} for _ in range(codesign.NOTARY_HISTORY_MAX_PAGES + 5)]
+        history = codesign.NotaryHistory(60)
+        self.assertIsNone(history.status('a'))
+        self.assertEqual(self.fetched, list(range(codesign.NOTARY_HISTORY_MAX_PAGES)))
+
+    def test_refreshed_once_stale(self):
+        history = codesign.NotaryHistory(0)
+        history.status('a')
+        history.status('a')
+        self.assertEqual(self.fetched, [0, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()